@@ -0,0 +1,427 @@
+"""Synthetic dumps and a stage by stage benchmark of the SLI pipelines.
+
+make_dump builds targets, states and propagations dataframes with the schema of the real dumps at any size, and
+write_dump saves them as an HDF5 dump readable by SLI_loader. benchmark_stages times every stage of the pipelines on
+such a dump and scaling repeats it over growing numbers of targets. verify_stages checks the stages on a small dump
+against frozen copies of the original row by row functions, and reports the intended differences.
+
+    python SLI_benchmark.py --sizes 100 300 1000 --output scaling.csv
+    python SLI_benchmark.py --verify
+"""
+import argparse
+import datetime
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+import SLI_functions as sli
+
+STAGES = ('eigen','state_binning','closest_state','prop_index','prop_lookup','epoch_lookup','percentiles')
+
+def make_dump(n_targets=100,states_per_target=30,days=30,cadence_hours=6,prop_days=4,start='2022-10-01',seed=0):
+    """Function that generates a synthetic dump.
+    Args:
+        n_targets: number of targets, about 60% of them debris (type_id 2)
+        states_per_target: number of states of every target, created at random times over the days
+        days: number of days covered by the states
+        cadence_hours: time between two propagations of a state
+        prop_days: propagations of a state go from its epoch up to prop_days days after it
+        start: date of the first day
+        seed: seed of the random generator
+    Returns:
+        targets_df, states_df, props_df with the columns of the real dumps. State ids grow with the state epochs, and
+        the covariances are random positive definite matrices growing with the time from epoch.
+    """
+    rng = np.random.default_rng(seed)
+    perigee = rng.uniform(300,900,n_targets)
+    targets_df = pd.DataFrame({'id':np.arange(1,n_targets+1),
+                               'type_id':rng.choice([1,2,3],n_targets,p=[0.2,0.6,0.2]),
+                               'perigee':perigee,'apogee':perigee+rng.exponential(100,n_targets)})
+    
+    n_states = n_targets*states_per_target
+    target_ids = np.repeat(targets_df['id'].to_numpy(),states_per_target)
+    epochs_ns = (sli.to_unix_ns(pd.Timestamp(start))[0] +
+                 rng.integers(0,int(days*86400),n_states)*sli.NS_PER_SECOND)
+    state_ids = np.empty(n_states,dtype=np.int64)
+    state_ids[np.argsort(epochs_ns,kind='stable')] = 1000 + np.arange(n_states)
+    order = np.lexsort((epochs_ns,target_ids))
+    states_df = pd.DataFrame({'id':state_ids[order],'target_id':target_ids[order],
+                              'timestamp':pd.to_datetime(epochs_ns[order])})
+    
+    n_steps = int(prop_days*24//cadence_hours) + 1
+    step = np.tile(np.arange(n_steps),n_states)
+    A = rng.normal(size=(n_states*n_steps,3,3))*(1 + step)[:,np.newaxis,np.newaxis]
+    C = np.einsum('nij,nkj->nik',A,A)
+    props_df = pd.DataFrame({'target_state_id':np.repeat(states_df['id'].to_numpy(),n_steps),
+                             'timestamp':np.repeat(epochs_ns[order]/sli.NS_PER_SECOND,n_steps) +
+                                         step*cadence_hours*3600.0,
+                             'covariance_xx':C[:,0,0],'covariance_xy':C[:,0,1],'covariance_xz':C[:,0,2],
+                             'covariance_yy':C[:,1,1],'covariance_yz':C[:,1,2],'covariance_zz':C[:,2,2]})
+    
+    return targets_df, states_df, props_df
+
+def write_dump(path,targets_df,states_df,props_df,format='table'):
+    """Function that writes dataframes as an HDF5 dump, in table format with the id columns SLI_loader filters on as
+       data columns, or in fixed format."""
+    with pd.HDFStore(path,mode='w') as store:
+        if format == 'table':
+            store.put('targets',targets_df,format='table')
+            store.put('states',states_df,format='table',data_columns=['target_id'])
+            store.put('propagations',props_df,format='table',data_columns=['target_state_id'])
+        else:
+            store.put('targets',targets_df)
+            store.put('states',states_df)
+            store.put('propagations',props_df)
+
+"""Frozen references: the row by row functions of the original notebooks, kept unchanged apart from returning their
+results instead of appending them to the Day objects. Do not update them with the pipelines, they are what the
+pipelines are checked against."""
+
+def baseline_eigenvalues(props_df):
+    """Function that computes the 3 eigenvalues of the covariance matrix of every propagation, one matrix at a time, as
+       the original add_eig_columns_to_props. Returns an (N,3) array in decreasing order."""
+    xx = props_df["covariance_xx"].values
+    xy = props_df["covariance_xy"].values
+    xz = props_df["covariance_xz"].values
+    yy = props_df["covariance_yy"].values
+    yz = props_df["covariance_yz"].values
+    zz = props_df["covariance_zz"].values
+    
+    A = np.stack((xx,xy,xz,xy,yy,yz,xz,yz,zz),axis=1)
+    
+    eig1 = []
+    eig2 = []
+    eig3 = []
+    for i in range(len(props_df)):
+        B = np.reshape(A[i,:],(3,3))
+        eigs_B = np.linalg.eigvals(B)
+        eigs_B = sorted(eigs_B,reverse=True)
+        eig1.append(eigs_B[0])
+        eig2.append(eigs_B[1])
+        eig3.append(eigs_B[2])
+    
+    return np.stack((eig1,eig2,eig3),axis=1)
+
+def baseline_which_state_ids_belong_to_day(state_ids,states_df,day):
+    """Function that puts the states created at a day in its states_bin and 8hr bins, as the original 
+       which_state_ids_belong_to_day (a state created at 08:xx belongs to the first bin)."""
+    date_string = day.date_string_of_day()
+    for state_id in state_ids:
+        ts_of_state = states_df.loc[(states_df['id']==state_id),'timestamp']
+        hour = int((ts_of_state.iloc[0].isoformat().split('T')[1]).split(':')[0])
+        if ts_of_state.iloc[0].isoformat().split('T')[0] == date_string:
+            day.states_bin.append(state_id)
+            if hour <=8:
+                day.states_bins_8hr[0].append(state_id)
+            elif (8 < hour <=16):
+                day.states_bins_8hr[1].append(state_id)
+            else:
+                day.states_bins_8hr[2].append(state_id)
+        else:          
+            pass
+
+def baseline_x_day_props_of_state(state_id,props_df,states_df,x):
+    """Function that returns the eigenvalues and rms of the propagation at exactly x days from the epoch of a state, as
+       the body of the original grab_one_day_props_for_each_day (and its 2 and 3 day copies). The propagation is matched
+       on its timestamp only. Raises IndexError when there is none."""
+    one_day = 24*60*60
+    st_ts_series = states_df.loc[(states_df['id'] == state_id),'timestamp']
+    st_ts = st_ts_series.iloc[0].timestamp()
+    st_x_day_props = props_df.loc[
+            props_df['timestamp']==st_ts+x*one_day,
+            ['covariance_xx','covariance_yy','covariance_zz','Eig1','Eig2','Eig3']]
+    eig_1 = st_x_day_props['Eig1'].iloc[0]
+    eig_2 = st_x_day_props['Eig2'].iloc[0]
+    eig_3 = st_x_day_props['Eig3'].iloc[0]
+    cov_x = st_x_day_props['covariance_xx'].iloc[0]
+    cov_y = st_x_day_props['covariance_yy'].iloc[0]
+    cov_z = st_x_day_props['covariance_zz'].iloc[0]
+    return eig_1, eig_2, eig_3, np.sqrt(cov_x+cov_y+cov_z)
+
+def baseline_find_closest_state_of_target_to_now(target_id,states_df,now,cutoff=7):
+    """Function that finds the closest state of a target to now, as the original find_closest_state_of_target_to_now.
+       Returns the state id, NaN when there is none within cutoff days."""
+    state_ids_of_target = states_df.loc[states_df['target_id']==target_id,'id']
+    
+    closest_state_id = np.nan
+    
+    diff = []
+    for state_id in state_ids_of_target:
+        ts = states_df.loc[(states_df['id']==state_id),'timestamp'].iloc[0]
+        if now >= ts:
+            diff.append((now-ts,state_id))
+    
+    if diff:
+        diffsort = sorted(diff,key=lambda x:x[0])
+        if diffsort[0][0]<datetime.timedelta(days=cutoff):
+            closest_state_id = diffsort[0][1]
+    
+    return closest_state_id
+
+def baseline_find_prop_closest_to_x_days_from_now(state_id,states_df,props_df,now,x=1):
+    """Function that finds the eigenvalues and rms of the propagation of a state closest to x days from now, as the
+       original find_prop_closest_to_x_days_from_now. now is a pandas Timestamp (UTC)."""
+    one_day = 24*60*60
+    
+    now_plus_1d = now.timestamp() + x*one_day
+    
+    all_props_of_state = props_df.loc[(props_df['target_state_id']==state_id),'timestamp']
+    
+    diff = []
+    for prop_ts in all_props_of_state:
+        diff.append(((abs(now_plus_1d - prop_ts)),prop_ts))
+        diffsort = sorted(diff,key=lambda x:x[0])
+    timestamp_of_closest_prop = diffsort[0][1]
+    
+    x_day_props = props_df.loc[
+                    ((props_df['target_state_id']==state_id)&
+                    (props_df['timestamp']>=timestamp_of_closest_prop)&
+                    (props_df['timestamp']<=(timestamp_of_closest_prop+1))),
+                    ['covariance_xx','covariance_yy','covariance_zz','Eig1','Eig2','Eig3']]
+
+    eig_1 = x_day_props['Eig1'].iloc[0]
+    eig_2 = x_day_props['Eig2'].iloc[0]
+    eig_3 = x_day_props['Eig3'].iloc[0]
+    cov_x = x_day_props['covariance_xx'].iloc[0]
+    cov_y = x_day_props['covariance_yy'].iloc[0]
+    cov_z = x_day_props['covariance_zz'].iloc[0]
+    
+    rms = np.sqrt(cov_x+cov_y+cov_z)
+    
+    return eig_1, eig_2, eig_3, rms
+
+def naive_quantiles(table,quantiles=(10,25,50,75,95)):
+    """Function that computes the quantiles of every (day, bin, horizon, metric) group of a PropTable with np.percentile
+       one group at a time, as the original percentiles_1d_prop. Returns a dataframe indexed like prop_quantiles, without
+       the empty groups."""
+    df = table.to_frame()
+    rows = {}
+    for (day, bin_num, horizon), group in df.groupby(['day','bin','horizon']):
+        for metric in sli.METRICS:
+            values = group[metric].dropna().to_numpy()
+            if len(values):
+                rows[(day,bin_num,horizon,metric)] = np.percentile(values,quantiles)
+    index = pd.MultiIndex.from_tuples(list(rows),names=['day','bin','horizon','metric'])
+    return pd.DataFrame(list(rows.values()),index=index,columns=pd.Index(np.asarray(quantiles,dtype=np.float64),
+                                                                        name='quantile'))
+
+def bins_of_states(day_list):
+    """Helper function that returns a dictionary state id -> (day position, bin number) of the bins of the days."""
+    return {int(state_id):(d,i) for d, day in enumerate(day_list) for i, states in enumerate(day.states_bins_8hr)
+            for state_id in states}
+
+def epoch_props_by_state(table):
+    """Helper function that returns a dictionary (state id, horizon) -> (eig_1, eig_2, eig_3, rms) of a PropTable."""
+    return {(int(s),float(h)):(e1,e2,e3,r) for s, h, e1, e2, e3, r in
+            zip(table.state_id,table.horizon,table.eig_1,table.eig_2,table.eig_3,table.rms)}
+
+def baseline_epoch_props(day_list,props_df,states_df,horizons):
+    """Function that looks up with baseline_x_day_props_of_state the propagations of every state of the bins of the days.
+    Returns:
+        found: dictionary (state id, horizon) -> (eig_1, eig_2, eig_3, rms)
+        missing: set of the (state id, horizon) without a propagation, where the original functions stopped
+    """
+    found = {}
+    missing = set()
+    for state_id in bins_of_states(day_list):
+        for x in horizons:
+            try:
+                found[(state_id,float(x))] = baseline_x_day_props_of_state(state_id,props_df,states_df,x)
+            except IndexError:
+                missing.add((state_id,float(x)))
+    return found, missing
+
+def same_values(computed,expected):
+    """Helper function that checks that two dictionaries of tuples of values have the same keys and close values."""
+    if set(computed) != set(expected):
+        return False
+    keys = sorted(expected)
+    return np.allclose(np.array([computed[k] for k in keys],dtype=np.float64).reshape(-1),
+                       np.array([expected[k] for k in keys],dtype=np.float64).reshape(-1),equal_nan=True)
+
+def verify_stages(n_targets=12,states_per_target=10,days=8,horizons=(1,3),cutoff=7,seed=0):
+    """Function that checks the stages of the pipelines against the frozen references of the original functions on a 
+       small synthetic dump, with 8hr bins as the original.
+    Returns:
+        dictionary stage -> (True when the results agree, description of the intended differences or '')
+    """
+    targets_df, states_df, props_df = make_dump(n_targets,states_per_target,days,seed=seed)
+    states_df, props_df = sli.normalize_times(states_df,props_df)
+    target_ids = targets_df['id'].to_numpy()
+    state_ids = states_df['id'].to_numpy()
+    checks = {}
+    
+    eigs = baseline_eigenvalues(props_df)
+    checks['eigen'] = (np.allclose(sli.covariance_eigenvalues(props_df),eigs),'')
+    props_df['Eig1'] = np.real(eigs[:,0])
+    props_df['Eig2'] = np.real(eigs[:,1])
+    props_df['Eig3'] = np.real(eigs[:,2])
+    
+    # bins are half-open since TimeGrid: a state created at 08:xx (16:xx) is now in the second (third) bin
+    day_list = sli.create_day_list(states_df)
+    sli.sort_states_in_days(state_ids,states_df,day_list)
+    baseline_days = sli.create_day_list(states_df)
+    for day in baseline_days:
+        baseline_which_state_ids_belong_to_day(state_ids,states_df,day)
+    hours = dict(zip(states_df['id'],states_df['timestamp'].dt.hour))
+    expected = {state_id:(d,i+1 if hours[state_id] in (8,16) else i)
+                for state_id, (d,i) in bins_of_states(baseline_days).items()}
+    moved = sum(hours[state_id] in (8,16) for state_id in expected)
+    checks['state_binning'] = (bins_of_states(day_list) == expected and
+                               [day.states_bin for day in day_list] == [day.states_bin for day in baseline_days],
+                               '{} states created at 08:xx or 16:xx moved to the next bin'.format(moved))
+    
+    day_list = sli.create_day_list(states_df)
+    grid = sli.TimeGrid.of_days(day_list)
+    closest = sli.StateIndex(states_df,target_ids).closest_states(target_ids[np.newaxis,:],
+                                                                  grid.bin_starts[:,np.newaxis],cutoff)
+    expected = np.array([[baseline_find_closest_state_of_target_to_now(target_id,states_df,day.now[i],cutoff)
+                          for target_id in target_ids] for day in day_list for i in range(day.n_bins)],dtype=np.float64)
+    checks['closest_state'] = (np.array_equal(closest,expected,equal_nan=True),'')
+    
+    sli.sort_target_states_in_days(day_list,target_ids,states_df,cutoff)
+    prop_index = sli.PropagationIndex(props_df,states_df)
+    agree = True
+    for x in horizons:
+        table = sli.per_target_x_day_props_all_days(day_list,states_df,props_df,x,prop_index)
+    for row in range(len(table)):
+        now = pd.Timestamp(int(grid.bin_start_of(table.day[row],table.bin[row])))
+        expected = baseline_find_prop_closest_to_x_days_from_now(table.state_id[row],states_df,props_df,now,
+                                                                 table.horizon[row])
+        computed = (table.eig_1[row],table.eig_2[row],table.eig_3[row],table.rms[row])
+        agree &= np.allclose(computed,np.asarray(expected,dtype=np.float64))
+    checks['prop_lookup'] = (bool(agree),'')
+    
+    expected = naive_quantiles(table)
+    computed = sli.prop_quantiles(table).dropna(how='all')
+    checks['percentiles'] = (computed.index.equals(expected.index) and
+                             np.allclose(computed.to_numpy(),expected.to_numpy(),equal_nan=True),'')
+    
+    # the 2 day propagation of some states is removed and the 1 day one of others is moved by half a second: the 
+    # original functions stop on both, the pipeline reports them as missing below the tolerance and finds the moved ones
+    # within it
+    epoch_horizons = (1,2,3)
+    epochs = sli.state_epochs_of_ids(props_df['target_state_id'],states_df)[0]
+    offsets = props_df['timestamp'].to_numpy() - epochs/sli.NS_PER_SECOND
+    rng = np.random.default_rng(seed)
+    dropped = rng.choice(np.flatnonzero(offsets == 2*86400),5,replace=False)
+    shifted = rng.choice(np.flatnonzero(offsets == 86400),5,replace=False)
+    exact_props = props_df.drop(index=dropped)
+    shifted_props = props_df.copy()
+    shifted_props.loc[shifted,'timestamp'] += 0.5
+    shifted_props.loc[shifted,'epoch_ns'] += sli.NS_PER_SECOND//2
+    shifted_props = shifted_props.drop(index=dropped)
+    
+    agree = True
+    for tolerance, reference in ((1.0,exact_props),(0.25,shifted_props)):
+        day_list = sli.create_day_list(states_df)
+        sli.sort_states_in_days(state_ids,states_df,day_list)
+        table, missing = sli.props_for_all_days(day_list,shifted_props,states_df,epoch_horizons,tolerance)
+        found, expected_missing = baseline_epoch_props(day_list,reference,states_df,epoch_horizons)
+        agree &= same_values(epoch_props_by_state(table),found)
+        agree &= set(zip(missing['state_id'].tolist(),missing['horizon'].astype(float).tolist())) == expected_missing
+    checks['epoch_lookup'] = (bool(agree),'')
+    
+    return checks
+
+"""Timing"""
+
+def time_stage(function,setup=None,repeat=3):
+    """Function that returns the best wall time (in seconds) of repeat calls of function(*setup()), setup not timed."""
+    best = np.inf
+    for i in range(repeat):
+        args = setup() if setup is not None else ()
+        start = time.perf_counter()
+        function(*args)
+        best = min(best,time.perf_counter() - start)
+    return best
+
+def benchmark_stages(targets_df,states_df,props_df,horizons=(1,3),bin_hours=8,cutoff=7,repeat=3):
+    """Function that times every stage of the pipelines on a dump.
+    Returns:
+        dictionary stage -> best wall time in seconds, see STAGES
+    """
+    states_df, props_df = sli.normalize_times(states_df,props_df)
+    target_ids = targets_df['id'].to_numpy()
+    state_ids = sli.collect_state_ids(targets_df,states_df)
+    prop_index = sli.PropagationIndex(props_df,states_df)
+    
+    def new_days():
+        return (sli.create_day_list(states_df,bin_hours),)
+    
+    def days_with_closest_states():
+        day_list = sli.create_day_list(states_df,bin_hours)
+        sli.sort_target_states_in_days(day_list,target_ids,states_df,cutoff)
+        return (day_list,)
+    
+    def days_with_states():
+        day_list = sli.create_day_list(states_df,bin_hours)
+        sli.sort_states_in_days(state_ids,states_df,day_list)
+        return (day_list,)
+    
+    def now_lookup(day_list):
+        for x in horizons:
+            sli.per_target_x_day_props_all_days(day_list,states_df,props_df,x,prop_index)
+    
+    day_list = days_with_closest_states()[0]
+    now_lookup(day_list)
+    table = sli.collect_props(day_list)
+    
+    return {'eigen':time_stage(lambda: sli.covariance_eigenvalues(props_df),repeat=repeat),
+            'state_binning':time_stage(lambda days: sli.sort_states_in_days(state_ids,states_df,days),new_days,repeat),
+            'closest_state':time_stage(lambda days: sli.sort_target_states_in_days(days,target_ids,states_df,cutoff),
+                                       new_days,repeat),
+            'prop_index':time_stage(lambda: sli.PropagationIndex(props_df,states_df),repeat=repeat),
+            'prop_lookup':time_stage(now_lookup,days_with_closest_states,repeat),
+            'epoch_lookup':time_stage(lambda days: sli.props_for_all_days(days,props_df,states_df,horizons,
+                                                                          prop_index=prop_index),
+                                      days_with_states,repeat),
+            'percentiles':time_stage(lambda: sli.prop_quantiles(table,day_list=day_list),repeat=repeat)}
+
+def scaling(sizes=(100,300,1000),states_per_target=30,days=30,cadence_hours=6,repeat=3,seed=0):
+    """Function that runs benchmark_stages on synthetic dumps of growing numbers of targets.
+    Returns:
+        dataframe with one row per size and stage: 'n_targets', 'n_states', 'n_props', 'stage', 'seconds'
+    """
+    rows = []
+    for n_targets in sizes:
+        targets_df, states_df, props_df = make_dump(n_targets,states_per_target,days,cadence_hours,seed=seed)
+        timings = benchmark_stages(targets_df,states_df,props_df,repeat=repeat)
+        for stage in STAGES:
+            rows.append((n_targets,len(states_df),len(props_df),stage,timings[stage]))
+    return pd.DataFrame(rows,columns=['n_targets','n_states','n_props','stage','seconds'])
+
+def main(argv=None):
+    """Function that runs the benchmark from the command line, returns the exit status."""
+    parser = argparse.ArgumentParser(description="Benchmark the SLI stages on synthetic dumps.")
+    parser.add_argument('--sizes',type=int,nargs='+',default=[100,300,1000],help="numbers of targets")
+    parser.add_argument('--states-per-target',type=int,default=30)
+    parser.add_argument('--days',type=int,default=30)
+    parser.add_argument('--cadence-hours',type=float,default=6)
+    parser.add_argument('--repeat',type=int,default=3,help="timed calls per stage, the best one is kept")
+    parser.add_argument('--output',default=None,help="CSV file for the scaling table (default: print it)")
+    parser.add_argument('--verify',action='store_true',help="only check the stages against the original functions")
+    parser.add_argument('--write-dump',default=None,help="only write a synthetic dump of the first size to this path")
+    args = parser.parse_args(argv)
+    
+    if args.verify:
+        checks = verify_stages()
+        for stage, (ok, note) in checks.items():
+            print('{:<15}{:<10}{}'.format(stage,'ok' if ok else 'MISMATCH',note))
+        return 0 if all(ok for ok, note in checks.values()) else 1
+    
+    if args.write_dump is not None:
+        write_dump(args.write_dump,*make_dump(args.sizes[0],args.states_per_target,args.days,args.cadence_hours))
+        return 0
+    
+    table = scaling(args.sizes,args.states_per_target,args.days,args.cadence_hours,args.repeat)
+    if args.output is not None:
+        table.to_csv(args.output,index=False)
+    else:
+        print(table.pivot(index='stage',columns='n_targets',values='seconds').loc[list(STAGES)].to_string())
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
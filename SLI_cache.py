@@ -0,0 +1,140 @@
+"""On-disk memoization of the expensive SLI pipeline stages.
+
+Results are keyed by a fingerprint of the input dump (or dataframes) and the stage parameters, so re-running a notebook
+on the same dump skips straight to aggregation. The cache is kept under a size limit by evicting the least recently 
+used entries.
+"""
+import hashlib
+import json
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+
+import SLI_functions as sli
+
+def fingerprint_frame(df):
+    """Function that returns a content fingerprint (hex string) of a dataframe, independent of where it was loaded from."""
+    h = hashlib.sha256()
+    h.update(json.dumps([str(c) for c in df.columns]).encode())
+    h.update(pd.util.hash_pandas_object(df,index=False).to_numpy().tobytes())
+    return h.hexdigest()
+
+def fingerprint_values(*values):
+    """Function that returns a fingerprint (hex string) of parameters such as horizons, cutoffs or id lists."""
+    h = hashlib.sha256()
+    for value in values:
+        if isinstance(value,np.ndarray):
+            h.update(str(value.dtype).encode())
+            h.update(np.ascontiguousarray(value).tobytes())
+        else:
+            h.update(repr(value).encode())
+        h.update(b'|')
+    return h.hexdigest()
+
+class StageCache():
+    """Class that stores the results of pipeline stages in cache_dir, one pickle file per (stage, key).
+    Args:
+        cache_dir: directory of the cache (created if needed)
+        max_bytes: size limit of the cache, least recently used entries are evicted above it
+    """
+    def __init__(self,cache_dir,max_bytes=10*2**30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir,exist_ok=True)
+    
+    def path(self,stage,key):
+        return os.path.join(self.cache_dir,'{}-{}.pkl'.format(stage,key))
+    
+    def fingerprint_file(self,path,block_size=2**23):
+        """Method that returns the content hash of a dump file. The hash is remembered for the file's (path, size, 
+           modification time), so an unchanged dump is only read once."""
+        stat = os.stat(path)
+        memo = os.path.join(self.cache_dir,'file-{}.sha256'.format(
+            fingerprint_values(os.path.abspath(path),stat.st_size,stat.st_mtime_ns)))
+        if os.path.exists(memo):
+            with open(memo) as f:
+                return f.read()
+        
+        h = hashlib.sha256()
+        with open(path,'rb') as f:
+            for block in iter(lambda: f.read(block_size),b''):
+                h.update(block)
+        with open(memo,'w') as f:
+            f.write(h.hexdigest())
+        return h.hexdigest()
+    
+    def memoize(self,stage,key,compute):
+        """Method that returns the cached result of a stage for key, calling compute() and storing its result on a miss."""
+        path = self.path(stage,key)
+        if os.path.exists(path):
+            with open(path,'rb') as f:
+                value = pickle.load(f)
+            os.utime(path)
+            return value
+        
+        value = compute()
+        tmp_path = path + '.tmp'
+        with open(tmp_path,'wb') as f:
+            pickle.dump(value,f,protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path,path)
+        self.evict()
+        return value
+    
+    def evict(self):
+        """Method that removes the least recently used entries until the cache is below max_bytes."""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.pkl'):
+                stat = os.stat(os.path.join(self.cache_dir,name))
+                entries.append((stat.st_mtime,stat.st_size,name))
+        total = sum(size for mtime, size, name in entries)
+        for mtime, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.cache_dir,name))
+            total -= size
+    
+    def clear(self):
+        for name in os.listdir(self.cache_dir):
+            os.remove(os.path.join(self.cache_dir,name))
+
+def add_eig_columns_to_props(cache,props_df,dump_key):
+    """Cached sli.add_eig_columns_to_props. dump_key is the fingerprint of the dump (StageCache.fingerprint_file) or of 
+       props_df (fingerprint_frame). The key also covers the (target_state_id, timestamp) rows of props_df, so different
+       filters of the same dump do not share their eigenvalues."""
+    key = fingerprint_values(dump_key,fingerprint_frame(props_df[['target_state_id','timestamp']]))
+    eigs = cache.memoize('eigs',key,lambda: sli.covariance_eigenvalues(props_df))
+    props_df["Eig1"] = eigs[:,0]
+    props_df["Eig2"] = eigs[:,1]
+    props_df["Eig3"] = eigs[:,2]
+    return props_df
+
+def sort_target_states_in_days(cache,day_list,target_id_list,states_df,dump_key,cutoff=7):
+    """Cached sli.sort_target_states_in_days. The bins of the days are restored from the cache on a hit."""
+    def compute():
+        sli.sort_target_states_in_days(day_list,target_id_list,states_df,cutoff)
+        return [day.states_bins_8hr for day in day_list]
+    
+    key = fingerprint_values(dump_key,np.asarray(target_id_list),cutoff,
+                             sli.TimeGrid.of_days(day_list).bin_starts)
+    bins = cache.memoize('closest-states',key,compute)
+    for day, day_bins in zip(day_list,bins):
+        day.states_bins_8hr = day_bins
+
+def per_target_props_all_days(cache,day_list,states_df,props_df,horizons,dump_key,prop_index=None):
+    """Cached sli.per_target_x_day_props_all_days for a list of horizons. Assumes the bins of the days are already filled.
+       Returns the PropTable of all days."""
+    def compute():
+        index = prop_index if prop_index is not None else sli.PropagationIndex(props_df,states_df)
+        new_days = [sli.Day(day.year,day.month,day.day,day.bin_hours) for day in day_list]
+        for new_day, day in zip(new_days,day_list):
+            new_day.states_bins_8hr = day.states_bins_8hr
+        for x in horizons:
+            sli.per_target_x_day_props_all_days(new_days,states_df,props_df,x,index)
+        return sli.collect_props(new_days)
+    
+    key = fingerprint_values(dump_key,list(horizons),[day.states_bins_8hr for day in day_list],
+                             sli.TimeGrid.of_days(day_list).bin_starts)
+    return sli.store_props(day_list,cache.memoize('per-target-props',key,compute))
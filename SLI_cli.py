@@ -0,0 +1,171 @@
+"""Command line entry point that runs the SLIs of a dump without the notebooks and writes the percentile tables.
+
+    python SLI_cli.py dump_20221115T193154.h5 --mode now --horizons 1 3 --output sli_now.parquet
+    python SLI_cli.py dump_20221115T193154.h5 --mode epoch --bin-hours 6 --output sli_epoch.csv --plot-dir figures
+
+Plotting libraries are only imported when --plot-dir is given.
+"""
+import argparse
+import os
+import sys
+
+import numpy as np
+
+import SLI_functions as sli
+import SLI_loader as ld
+import SLI_profile as profile
+
+DEFAULT_HORIZONS = {'now':(1,3),'epoch':(1,2,3)}
+
+def build_parser():
+    """Function that returns the argument parser of the command line."""
+    parser = argparse.ArgumentParser(description="Compute the SLI percentile tables of a dump.")
+    parser.add_argument('dump',help="path of the dump_<timestamp>.h5 file")
+    parser.add_argument('--mode',choices=('now','epoch'),default='now',
+                        help="propagations from the bin 'now's or from the state epochs (default: now)")
+    parser.add_argument('--output','-o',required=True,help="path of the percentile table, .parquet or .csv")
+    parser.add_argument('--format',choices=('parquet','csv'),default=None,
+                        help="format of the output (default: from the extension of --output)")
+    parser.add_argument('--type-id',default='2',help="type of the targets, 'all' for all types (default: 2, debris)")
+    parser.add_argument('--min-apogee',type=float,default=500,help="targets need apogee >= min-apogee (default: 500)")
+    parser.add_argument('--max-perigee',type=float,default=650,help="targets need perigee <= max-perigee (default: 650)")
+    parser.add_argument('--horizons',type=float,nargs='+',default=None,
+                        help="horizons in days (default: 1 3 in now mode, 1 2 3 in epoch mode)")
+    parser.add_argument('--bin-hours',type=float,default=8,help="width of the bins in hours (default: 8)")
+    parser.add_argument('--quantiles',type=float,nargs='+',default=[10,25,50,75,95],
+                        help="percentiles to compute (default: 10 25 50 75 95)")
+    parser.add_argument('--cutoff',type=float,default=7,
+                        help="now mode: states older than cutoff days are not used (default: 7)")
+    parser.add_argument('--tolerance',type=float,default=1.0,
+                        help="epoch mode: largest accepted propagation time difference in seconds (default: 1)")
+    parser.add_argument('--top-k',type=int,default=None,
+                        help="also write the K targets with the largest values of every bin, horizon and metric to "
+                             "<output>_top<K> (see sli.prop_top_k)")
+    parser.add_argument('--interpolate',action='store_true',
+                        help="now mode: interpolate the propagations at exactly now + horizon instead of the nearest")
+    parser.add_argument('--use-summary',action='store_true',
+                        help="read the propagation summary sidecar of the dump, building it if missing")
+    parser.add_argument('--prop-store',default=None,help="directory of a propagation store (see SLI_store) to use")
+    parser.add_argument('--workers',type=int,default=None,
+                        help="now mode: number of processes, not with --prop-store or --interpolate (default: run in "
+                             "this process)")
+    parser.add_argument('--plot-dir',default=None,help="directory where to also save the figure (see SLI_plotting)")
+    parser.add_argument('--plot-format',default='png',help="file format of the figure (default: png)")
+    parser.add_argument('--usetex',action='store_true',help="render the figure labels with LaTeX instead of mathtext")
+    parser.add_argument('--profile',default=None,
+                        help="path of a JSON report of the time, memory and row counts of every stage (see SLI_profile)")
+    return parser
+
+def run_pipeline(targets_df,states_df,props_df,mode='now',horizons=(1,3),bin_hours=8,cutoff=7,tolerance=1.0,
+                 prop_index=None,n_workers=None,method='nearest'):
+    """Function that runs one of the two pipelines on loaded dataframes.
+    Args:
+        targets_df: filtered targets dataframe (only relevant targets)
+        states_df: states dataframe
+        props_df: propagations dataframe or summary, None when prop_index is given
+        mode: 'now' for propagations from the bin 'now's, 'epoch' for propagations from state epoch
+        horizons: horizons (in days) of the propagations
+        bin_hours: width of the bins of the days, see sli.Day
+        cutoff: in 'now' mode, states older than cutoff days are not used
+        tolerance: in 'epoch' mode, see sli.props_for_all_days
+        prop_index: optional prebuilt (or memory-mapped) sli.PropagationIndex
+        n_workers: in 'now' mode, number of processes (see SLI_parallel), None runs in this process. Not supported with
+                   prop_index or method 'interpolate'.
+        method: in 'now' mode, 'nearest' or 'interpolate' (see sli.PropagationIndex.query)
+    Returns:
+        day_list: list of Day objects, with their props
+        table: PropTable of all days
+    """
+    if n_workers is not None and (mode == 'epoch' or prop_index is not None or method != 'nearest'):
+        raise ValueError("n_workers is only supported in 'now' mode, with method 'nearest' and without prop_index")
+    day_list = sli.create_day_list(states_df,bin_hours)
+    target_ids = targets_df['id'].to_numpy()
+    
+    if mode == 'epoch':
+        state_ids = states_df.loc[states_df['target_id'].isin(targets_df['id']),'id'].to_list()
+        sli.sort_states_in_days(state_ids,states_df,day_list)
+        table, _ = sli.props_for_all_days(day_list,props_df,states_df,horizons,tolerance,prop_index)
+        return day_list, table
+    
+    if n_workers is not None:
+        import SLI_parallel
+        table = SLI_parallel.now_props_all_days_parallel(day_list,target_ids,states_df,props_df,horizons,cutoff,
+                                                         n_workers)
+        return day_list, table
+    
+    if prop_index is None:
+        prop_index = sli.PropagationIndex(props_df,states_df)
+    sli.sort_target_states_in_days(day_list,target_ids,states_df,cutoff)
+    table = sli.collect_props(day_list)
+    for x in horizons:
+        table = sli.per_target_x_day_props_all_days(day_list,states_df,props_df,x,prop_index,method)
+    return day_list, table
+
+def quantile_frame(table,day_list,quantiles,horizons):
+    """Function that returns the percentile table written by the command line: one row per (day, bin, horizon, metric)
+       with the date of the day, the bin start in hours and one 'p<quantile>' column per percentile."""
+    df = sli.prop_quantiles(table,quantiles,day_list,horizons).reset_index()
+    dates = np.array(sli.xtick_labels(day_list))
+    bin_hours = np.array([day.bin_hours for day in day_list],dtype=np.float64)
+    df.insert(0,'date',dates[df['day'].to_numpy()])
+    df.insert(2,'bin_start_hours',df['bin'].to_numpy()*bin_hours[df['day'].to_numpy()])
+    return df.rename(columns={q:'p{:g}'.format(q) for q in np.asarray(quantiles,dtype=np.float64)})
+
+def write_table(df,path,fmt=None):
+    """Function that writes a table as Parquet or CSV, the format being taken from the extension when not given."""
+    if fmt is None:
+        fmt = 'parquet' if os.path.splitext(path)[1].lower() in ('.parquet','.pq') else 'csv'
+    if fmt == 'parquet':
+        df.to_parquet(path,index=False)
+    else:
+        df.to_csv(path,index=False)
+
+def main(argv=None):
+    """Function that runs the command line, returns the exit status."""
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.prop_store is not None and args.use_summary:
+        parser.error("--prop-store and --use-summary are exclusive")
+    if args.mode == 'epoch' and args.interpolate:
+        parser.error("--interpolate is only used in now mode")
+    if args.workers is not None:
+        if args.mode == 'epoch':
+            parser.error("--workers is only used in now mode")
+        if args.prop_store is not None:
+            parser.error("--workers and --prop-store are exclusive")
+        if args.interpolate:
+            parser.error("--workers and --interpolate are exclusive")
+    
+    type_id = None if args.type_id == 'all' else int(args.type_id)
+    horizons = tuple(args.horizons) if args.horizons else DEFAULT_HORIZONS[args.mode]
+    if args.profile is not None:
+        profile.enable()
+    
+    targets_df, states_df, props_df = ld.load_dump(args.dump,type_id,args.min_apogee,args.max_perigee,
+                                                   use_summary=args.use_summary,
+                                                   load_props=args.prop_store is None)
+    prop_index = None
+    if args.prop_store is not None:
+        import SLI_store
+        prop_index = SLI_store.open_prop_store(args.prop_store)
+    
+    day_list, table = run_pipeline(targets_df,states_df,props_df,args.mode,horizons,args.bin_hours,args.cutoff,
+                                   args.tolerance,prop_index,args.workers,
+                                   'interpolate' if args.interpolate else 'nearest')
+    df = quantile_frame(table,day_list,args.quantiles,horizons)
+    write_table(df,args.output,args.format)
+    if args.top_k is not None:
+        top = sli.prop_top_k(table,args.top_k,day_list,horizons).reset_index()
+        top.insert(0,'date',np.array(sli.xtick_labels(day_list))[top['day'].to_numpy()])
+        stem, ext = os.path.splitext(args.output)
+        write_table(top,'{}_top{}{}'.format(stem,args.top_k,ext),args.format)
+    
+    if args.plot_dir is not None:
+        import SLI_plotting
+        SLI_plotting.render_report(df,args.plot_dir,args.mode,args.plot_format,args.usetex)
+    if args.profile is not None:
+        profile.disable().to_json(args.profile)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
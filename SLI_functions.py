@@ -1,5 +1,13 @@
 import numpy as np
+import pandas as pd
 import datetime
+import os
+
+import SLI_profile as profile
+
+NS_PER_SECOND = 10**9
+NS_PER_HOUR = 60*60*NS_PER_SECOND
+NS_PER_DAY = 24*NS_PER_HOUR
 
 def leap_year(year):
     """Recognizes if a year is a leap year and return boolean True if it is."""
@@ -47,6 +55,160 @@ def next_day(year, month, day):
     return next_year,next_month, next_day
 
 
+def to_unix_ns(values):
+    """Helper function that converts datetimes (or an iterable of them) to int64 nanoseconds since the unix epoch. 
+       Naive datetimes are taken to be in UTC."""
+    ts = pd.DatetimeIndex(pd.to_datetime(np.atleast_1d(values)))
+    if ts.tz is not None:
+        ts = ts.tz_convert('UTC').tz_localize(None)
+    return ts.to_numpy(dtype='datetime64[ns]').view(np.int64)
+
+def seconds_to_ns(seconds):
+    """Helper function that converts unix seconds (floats) to int64 unix nanoseconds."""
+    return np.round(np.asarray(seconds,dtype=np.float64)*NS_PER_SECOND).astype(np.int64)
+
+def hours_to_ns(hours):
+    """Helper function that converts a duration in hours to int64 nanoseconds."""
+    return np.round(np.asarray(hours,dtype=np.float64)*NS_PER_HOUR).astype(np.int64)
+
+def day_start_ns(ns):
+    """Helper function that returns the start (midnight UTC) of the day of int64 unix nanoseconds timestamps."""
+    return ns - ns%NS_PER_DAY
+
+def normalize_times(states_df,props_df=None):
+    """Function that adds an int64 'epoch_ns' column (unix nanoseconds, UTC) to the states, from their pandas timestamps, 
+       and to the propagations, from their float unix seconds. Meant to be called once at ingestion, after which all 
+       comparisons, offsets and day boundaries are done on these integers. Returns the dataframes.
+    """
+    states_df['epoch_ns'] = to_unix_ns(states_df['timestamp'])
+    if props_df is not None:
+        props_df['epoch_ns'] = seconds_to_ns(props_df['timestamp'])
+    return states_df, props_df
+
+def state_epoch_ns(states_df):
+    """Helper function that returns the int64 unix nanoseconds of the states, from 'epoch_ns' when normalized."""
+    if 'epoch_ns' in states_df.columns:
+        return states_df['epoch_ns'].to_numpy(dtype=np.int64)
+    return to_unix_ns(states_df['timestamp'])
+
+def prop_epoch_ns(props_df):
+    """Helper function that returns the int64 unix nanoseconds of the propagations, from 'epoch_ns' when normalized."""
+    if 'epoch_ns' in props_df.columns:
+        return props_df['epoch_ns'].to_numpy(dtype=np.int64)
+    return seconds_to_ns(props_df['timestamp'])
+
+def state_positions_of_ids(state_ids,states_df):
+    """Helper function that returns the row positions in states_df of the given state ids (the first row of a duplicated
+       id), -1 for unknown ids."""
+    ids = states_df['id'].to_numpy()
+    rows = np.flatnonzero(~pd.Index(ids).duplicated())
+    positions = pd.Index(ids[rows]).get_indexer(np.asarray(state_ids,dtype=np.int64))
+    if len(rows) == 0:
+        return positions
+    return np.where(positions >= 0,rows[np.maximum(positions,0)],-1)
+
+def state_epochs_of_ids(state_ids,states_df):
+    """Helper function that returns the int64 unix nanoseconds of the given state ids (0 for unknown ids), and a mask of
+       the ids found. The epochs are taken by position, so they stay exact int64."""
+    positions = state_positions_of_ids(state_ids,states_df)
+    found = positions >= 0
+    epochs = np.zeros(positions.shape,dtype=np.int64)
+    epochs[found] = state_epoch_ns(states_df)[positions[found]]
+    return epochs, found
+
+def segmented_searchsorted(times,lo,hi,values,side='left'):
+    """Helper function that performs np.searchsorted of every value inside its own sorted segment times[lo:hi], with one
+       vectorized bisection step per halving of the longest segment. Only the probed elements of times are read, so it 
+       works on memory-mapped arrays without loading them.
+    Returns:
+        positions: int64 array, lo <= positions <= hi
+    """
+    lo = np.array(lo,dtype=np.int64)
+    hi = np.array(hi,dtype=np.int64)
+    active = np.flatnonzero(lo < hi)
+    while len(active):
+        l = lo[active]
+        h = hi[active]
+        mid = (l+h)//2
+        if side == 'left':
+            go_right = times[mid] < values[active]
+        else:
+            go_right = times[mid] <= values[active]
+        lo[active] = np.where(go_right,mid+1,l)
+        hi[active] = np.where(go_right,h,mid)
+        active = active[lo[active] < hi[active]]
+    return lo
+
+def asof_positions(ref_keys,ref_times,qry_keys,qry_times,direction='backward'):
+    """Helper function that performs a vectorized as-of search of many queries against sorted references.
+    Args:
+        ref_keys, ref_times: arrays of the references, sorted by (key, time)
+        qry_keys, qry_times: arrays of the queries, in any order
+        direction: 'backward' looks for the last reference with time <= query time, 'forward' for the first reference
+                   with time >= query time. Only references with the same key as the query are considered.
+    Returns:
+        positions: int64 array with the position in the reference arrays for every query, -1 where there is none. 
+                   Among references with equal key and time the first one is returned.
+    """
+    qry_keys = np.asarray(qry_keys)
+    qry_times = np.asarray(qry_times)
+    seg_lo = np.searchsorted(ref_keys,qry_keys,'left')
+    seg_hi = np.searchsorted(ref_keys,qry_keys,'right')
+    
+    if direction == 'backward':
+        positions = segmented_searchsorted(ref_times,seg_lo,seg_hi,qry_times,'right') - 1
+        hit = positions >= seg_lo
+        # move to the first of references with equal key and time
+        positions[hit] = segmented_searchsorted(ref_times,seg_lo[hit],positions[hit],ref_times[positions[hit]],'left')
+    else:
+        positions = segmented_searchsorted(ref_times,seg_lo,seg_hi,qry_times,'left')
+        hit = positions < seg_hi
+    positions[~hit] = -1
+    
+    return positions
+
+def filter_targets(targets_df,type_id=2,min_apogee=500,max_perigee=650):
+    """Function that keeps the targets of one type whose orbit crosses an altitude band. 
+    Args:
+        targets_df: targets dataframe
+        type_id: type of the targets to keep (2 is debris), None keeps all types
+        min_apogee, max_perigee: the band, targets need apogee >= min_apogee and perigee <= max_perigee
+    Returns:
+        filtered targets dataframe. Targets with a missing id, type_id, perigee or apogee are dropped.
+    """
+    targets_df = targets_df[targets_df[['id','type_id','perigee','apogee']].notnull().all(axis=1)]
+    selected = (targets_df['apogee']>=min_apogee)&(targets_df['perigee']<=max_perigee)
+    if type_id is not None:
+        selected &= targets_df['type_id']==type_id
+    return targets_df[selected]
+
+class Population():
+    """Class that defines a population of targets for the SLIs: the targets of one type (None for all types) whose orbit 
+       crosses an altitude band.
+    """
+    def __init__(self,name,type_id=2,min_apogee=500,max_perigee=650):
+        self.name = name
+        self.type_id = type_id
+        self.min_apogee = min_apogee
+        self.max_perigee = max_perigee
+    
+    def select(self,targets_df):
+        """Method that returns the targets of the population."""
+        return filter_targets(targets_df,self.type_id,self.min_apogee,self.max_perigee)
+
+def population_membership(targets_df,populations):
+    """Function that tags the targets with the populations they belong to, a target can belong to several.
+    Args:
+        targets_df: targets dataframe
+        populations: list of Population objects
+    Returns:
+        dataframe with columns 'target_id' and 'population' (name), one row per (target, population). The pipeline is 
+        run once for membership['target_id'].unique() and the populations are separated at aggregation (prop_quantiles).
+    """
+    parts = [pd.DataFrame({'target_id':pop.select(targets_df)['id'].to_numpy(),'population':pop.name})
+             for pop in populations]
+    return pd.concat(parts,ignore_index=True)
+
 def collect_state_ids(tar_df,states_df):
     """Collects all state ids belonging to the relevant targets.
     Args: 
@@ -63,46 +225,92 @@ def collect_state_ids(tar_df,states_df):
     return all_state_ids
 
 def find_start_of_study(states_df):
-    """Finds date of start of study, given a states dataframe. Return raw ints."""
-    
-    start_date = min(states_df['timestamp']).isoformat().split('T')[0]
-    start_year = start_date.split('-')[0]
-    start_month = start_date.split('-')[1]
-    start_day = start_date.split('-')[2]
-    return start_year, start_month, start_day
+    """Finds date of start of study, given a states dataframe. Returns year, month and day as zero padded strings."""
+    start_date = date_of_unix_ns(state_epoch_ns(states_df).min())
+    return '{:04d}'.format(start_date.year), '{:02d}'.format(start_date.month), '{:02d}'.format(start_date.day)
 
 def find_end_of_study(states_df):
-    """Finds end date of study, given a states dataframe. Returns raw ints."""
-    end_date = max(states_df['timestamp']).isoformat().split('T')[0]
-    end_year = end_date.split('-')[0]
-    end_month = end_date.split('-')[1]
-    end_day = end_date.split('-')[2]
-    return end_year, end_month, end_day
+    """Finds end date of study, given a states dataframe. Returns year, month and day as zero padded strings."""
+    end_date = date_of_unix_ns(state_epoch_ns(states_df).max())
+    return '{:04d}'.format(end_date.year), '{:02d}'.format(end_date.month), '{:02d}'.format(end_date.day)
+
+class PropTable():
+    """Class that stores propagation elements column-wise in typed arrays, one row per (day, bin, horizon, state).
+       'day' is the position of the day in the day list the table was built for.
+    """
+    columns = ('day','bin','horizon','target_id','state_id','eig_1','eig_2','eig_3','rms')
+    dtypes = (np.int32,np.int16,np.float64,np.int64,np.int64,np.float64,np.float64,np.float64,np.float64)
+    __slots__ = columns
+    
+    def __init__(self,day,bin,horizon,target_id,state_id,eig_1,eig_2,eig_3,rms):
+        values = (day,bin,horizon,target_id,state_id,eig_1,eig_2,eig_3,rms)
+        for name, dtype, value in zip(self.columns,self.dtypes,values):
+            setattr(self,name,np.asarray(value,dtype=dtype))
+    
+    @classmethod
+    def empty(cls):
+        return cls(*[[] for name in cls.columns])
+    
+    @classmethod
+    def concat(cls,tables):
+        """Method that concatenates tables and sorts the rows by (day, bin, horizon), keeping the order of the states."""
+        tables = [table for table in tables if len(table)]
+        if not tables:
+            return cls.empty()
+        merged = cls(*[np.concatenate([getattr(table,name) for table in tables]) for name in cls.columns])
+        return merged[np.lexsort((merged.horizon,merged.bin,merged.day))]
+    
+    def __len__(self):
+        return len(self.day)
+    
+    def __getitem__(self,index):
+        """Rows selected by a slice (views, no copy), a boolean mask or an array of positions."""
+        return PropTable(*[getattr(self,name)[index] for name in self.columns])
+    
+    def with_day(self,day):
+        """Method that returns a copy of the table with all rows moved to the given day position."""
+        columns = [getattr(self,name) for name in self.columns]
+        columns[0] = np.full(len(self),day)
+        return PropTable(*columns)
+    
+    def to_frame(self):
+        """Method that returns the table as a dataframe."""
+        return pd.DataFrame({name:getattr(self,name) for name in self.columns})
 
 class Day():
-    """Class that defines a day of study.
+    """Class that defines a day of study, split in bins of bin_hours (8 by default, must divide 24). The state ids of 
+       each bin are in states_bins_8hr, whatever the bin width. The propagation elements of the day are kept in a 
+       PropTable (props). The per bin lists one_day_props_1 ... three_day_props_rms are read-only and built from it.
     """
-    def __init__(self,year,month,day):
+    __slots__ = ('year','month','day','bin_hours','states_bin','states_bins_8hr','props')
+    
+    def __init__(self,year,month,day,bin_hours=8):
+        if 24 % bin_hours:
+            raise ValueError("bin_hours must divide 24, got {}".format(bin_hours))
         self.year = year
         self.month = month
         self.day = day
+        self.bin_hours = bin_hours
         self.states_bin = []
-        self.states_bins_8hr = [[] for i in range(3)]
-        self.one_day_props_1 = [[] for i in range(3)]
-        self.one_day_props_2 = [[] for i in range(3)]
-        self.one_day_props_3 = [[] for i in range(3)]
-        self.one_day_props_rms = [[] for i in range(3)]
-        self.two_day_props_1 = [[] for i in range(3)]
-        self.two_day_props_2 = [[] for i in range(3)]
-        self.two_day_props_3 = [[] for i in range(3)]
-        self.two_day_props_rms = [[] for i in range(3)]
-        self.three_day_props_1 = [[] for i in range(3)]
-        self.three_day_props_2 = [[] for i in range(3)]
-        self.three_day_props_3 = [[] for i in range(3)]
-        self.three_day_props_rms = [[] for i in range(3)]
-        self.now =[datetime.datetime(self.year,self.month,self.day,0,0,0),
-                   datetime.datetime(self.year,self.month,self.day,8,0,0),
-                   datetime.datetime(self.year,self.month,self.day,16,0,0)]
+        self.states_bins_8hr = [[] for i in range(self.n_bins)]
+        self.props = PropTable.empty()
+    
+    @property
+    def n_bins(self):
+        return int(24//self.bin_hours)
+    
+    @property
+    def now(self):
+        """List with the start of every bin of the day."""
+        start = datetime.datetime(self.year,self.month,self.day)
+        return [start + datetime.timedelta(hours=i*self.bin_hours) for i in range(self.n_bins)]
+    
+    def bin_values(self,horizon,metric):
+        """Method that returns for each bin a list with the values of a metric ('eig_1', 'eig_2', 'eig_3' or 'rms') of 
+           the propagations at a horizon (in days)."""
+        values = getattr(self.props,metric)
+        at_horizon = self.props.horizon==horizon
+        return [values[at_horizon&(self.props.bin==i)].tolist() for i in range(self.n_bins)]
         
     def date_list_of_day(self):
         return [self.year,self.month,self.day]
@@ -120,29 +328,144 @@ class Day():
     
         return str(self.year) + "-" + month_str + "-" + day_str     
     
-def create_day_list(states_df):
-    """Function that creates a day object for each day of the study. Returns a list of days."""
-    start_year,start_month,start_day = find_start_of_study(states_df)
-    end_year,end_month,end_day = find_end_of_study(states_df)
-    
-    day_list = []
-    count_of_days = 0
-    year = int(start_year)
-    month = int(start_month)
-    day = int(start_day)
-    
-    while (day!=int(end_day)):
-        #print(year,month,day)
-        day_list.append(Day(year,month,day))
-        Nyear,Nmonth,Nday = next_day(year,month,day)
-        count_of_days += 1
-        year = Nyear
-        month = Nmonth
-        day = Nday    
-    return day_list
+def _bin_values_property(horizon,metric):
+    return property(lambda self: self.bin_values(horizon,metric))
+
+# Day.one_day_props_1, Day.two_day_props_rms, etc. of the per bin list layout
+for _horizon, _prefix in ((1,'one_day'),(2,'two_day'),(3,'three_day')):
+    for _suffix, _metric in (('1','eig_1'),('2','eig_2'),('3','eig_3'),('rms','rms')):
+        setattr(Day,_prefix+'_props_'+_suffix,_bin_values_property(_horizon,_metric))
+
+def store_props(day_list,table):
+    """Function that merges a PropTable built for day_list into the props of its days.
+    Returns:
+        merged: PropTable with the rows of all days, sorted by (day, bin, horizon). The props of every day are slices 
+                of it, so whole columns can be read from merged without copying.
+    """
+    parts = [day.props.with_day(d) for d, day in enumerate(day_list) if len(day.props)]
+    merged = PropTable.concat(parts+[table])
+    
+    bounds = np.searchsorted(merged.day,np.arange(len(day_list)+1))
+    for d, day in enumerate(day_list):
+        day.props = merged[bounds[d]:bounds[d+1]]
+    
+    return merged
+
+def target_ids_of_states(state_ids,states_df):
+    """Helper function that returns the target ids of the given state ids (-1 for unknown states)."""
+    positions = state_positions_of_ids(state_ids,states_df)
+    found = positions >= 0
+    targets = np.full(positions.shape,-1,dtype=np.int64)
+    targets[found] = states_df['target_id'].to_numpy(dtype=np.int64)[positions[found]]
+    return targets
+
+def date_of_unix_ns(ns):
+    """Helper function that returns the UTC date (datetime.date) of an int64 unix nanoseconds timestamp."""
+    return np.datetime64(int(ns),'ns').astype('datetime64[D]').item()
+
+class TimeGrid():
+    """Class that holds the bins of a study as arrays: bins of bin_hours (a divisor of 24) over the UTC days whose 
+       midnights are day_starts (int64 unix nanoseconds). All the day and bin arithmetic of the pipelines (bin starts, 
+       assignment of timestamps to bins, Day objects) is done here.
+    """
+    def __init__(self,day_starts,bin_hours=8):
+        if 24 % bin_hours:
+            raise ValueError("bin_hours must divide 24, got {}".format(bin_hours))
+        self.day_starts = np.asarray(day_starts,dtype=np.int64)
+        self.bin_hours = bin_hours
+        self.bins_per_day = int(24//bin_hours)
+        self.bin_ns = int(hours_to_ns(bin_hours))
+        
+        n_days = len(self.day_starts)
+        self.bin_starts = (self.day_starts[:,np.newaxis] + np.arange(self.bins_per_day)*self.bin_ns).ravel()
+        self.bin_day = np.repeat(np.arange(n_days),self.bins_per_day)
+        self.bin_number = np.tile(np.arange(self.bins_per_day),n_days)
+    
+    @classmethod
+    def between(cls,start_date,end_date,bin_hours=8):
+        """Method that creates the grid of the days from start_date up to (not including) end_date, both datetime.date 
+           objects."""
+        n_days = max((end_date-start_date).days,0)
+        dates = np.datetime64(start_date,'D')+np.arange(n_days)
+        return cls(dates.astype('datetime64[ns]').view(np.int64),bin_hours)
+    
+    @classmethod
+    def from_states(cls,states_df,bin_hours=8):
+        """Method that creates the grid from the day of the first state up to (not including) the day of the last one."""
+        ns = state_epoch_ns(states_df)
+        return cls.between(date_of_unix_ns(ns.min()),date_of_unix_ns(ns.max()),bin_hours)
+    
+    @classmethod
+    def of_days(cls,day_list):
+        """Method that creates the grid of the days of a list of Day objects, in the order of the list. All days must have
+           the same bin width."""
+        bin_hours = {day.bin_hours for day in day_list}
+        if len(bin_hours) > 1:
+            raise ValueError("All days must have the same bin_hours, got {}".format(sorted(bin_hours)))
+        dates = np.asarray([datetime.date(day.year,day.month,day.day) for day in day_list],dtype='datetime64[D]')
+        return cls(dates.astype('datetime64[ns]').view(np.int64),bin_hours.pop() if bin_hours else 8)
+    
+    def bin_start_of(self,day_index,bin_index):
+        """Method that returns the start (int64 unix nanoseconds) of the bins given by their day position and number."""
+        return self.bin_starts[np.asarray(day_index,dtype=np.int64)*self.bins_per_day + np.asarray(bin_index,dtype=np.int64)]
+    
+    def assign(self,timestamps):
+        """Method that assigns int64 unix nanoseconds timestamps to the grid.
+        Returns:
+            day_index, bin_index: arrays with the day position and bin number of each timestamp, -1 outside the grid
+        """
+        timestamps = np.asarray(timestamps,dtype=np.int64)
+        day_index = np.full(timestamps.shape,-1,dtype=np.int64)
+        bin_index = np.full(timestamps.shape,-1,dtype=np.int64)
+        if len(self.day_starts) == 0:
+            return day_index, bin_index
+        
+        starts = day_start_ns(timestamps)
+        order = np.argsort(self.day_starts,kind='stable')
+        pos = order[np.minimum(np.searchsorted(self.day_starts,starts,sorter=order),len(order)-1)]
+        inside = self.day_starts[pos] == starts
+        day_index[inside] = pos[inside]
+        bin_index[inside] = (timestamps[inside]-starts[inside])//self.bin_ns
+        return day_index, bin_index
+    
+    def day_list(self):
+        """Method that returns a Day object for each day of the grid."""
+        dates = self.day_starts.astype('datetime64[ns]').astype('datetime64[D]').tolist()
+        return [Day(date.year,date.month,date.day,self.bin_hours) for date in dates]
+
+def create_day_list(states_df,bin_hours=8):
+    """Function that creates a day object for each day of the study, from the day of the first state up to (not including)
+       the day of the last state. Returns a list of days."""
+    return TimeGrid.from_states(states_df,bin_hours).day_list()
+
+def create_day_list_between(start_date,end_date,bin_hours=8):
+    """Function that creates a day object for each day from start_date up to (not including) end_date. 
+       Both are datetime.date objects. Returns a list of days."""
+    return TimeGrid.between(start_date,end_date,bin_hours).day_list()
 
 """Functions that perform the propagation from state epoch"""
 
+def bin_states_by_day(state_ids,states_df,grid):
+    """Function that assigns every state to its day and bin in one vectorized pass over the timestamps.
+    Args:
+        state_ids: list of all relevant state ids of the targets
+        states_df: dataframe of states
+        grid: TimeGrid of the days. Bins start at midnight UTC, with 8hr bins a state created at 08:00 belongs to the 
+              second bin.
+    Returns:
+        binned: dataframe with columns 'state_id', 'day' (position of the day in the grid) and 'bin', in the order of 
+                state_ids. State ids missing from states_df and states outside the grid are dropped.
+    """
+    ns, valid = state_epochs_of_ids(state_ids,states_df)
+    day_index, bin_index = grid.assign(ns)
+    valid = valid & (day_index >= 0)
+    
+    return pd.DataFrame({'state_id':np.asarray(state_ids)[valid],'day':day_index[valid],'bin':bin_index[valid]})
+
+def date_key_of_day(day):
+    """Helper function that returns the integer key (year*10000 + month*100 + day) of a Day object."""
+    return day.year*10000 + day.month*100 + day.day
+
 def which_state_ids_belong_to_day(state_ids,states_df,day):
     """Function that determines if a state belongs to a given day.
     Args:
@@ -151,22 +474,9 @@ def which_state_ids_belong_to_day(state_ids,states_df,day):
         day: Object of the Day class that represents a day of the study. 
     If the state was created at that day, it's id will be added to the proper day.states_bin_8hr
     """
-    
-    date_string = day.date_string_of_day()
-    for state_id in state_ids:
-        ts_of_state = states_df.loc[(states_df['id']==state_id),'timestamp']
-        hour = int((ts_of_state.iloc[0].isoformat().split('T')[1]).split(':')[0])
-        if ts_of_state.iloc[0].isoformat().split('T')[0] == date_string:
-            day.states_bin.append(state_id)
-            if hour <=8:
-                day.states_bins_8hr[0].append(state_id)
-            elif (8 < hour <=16):
-                day.states_bins_8hr[1].append(state_id)
-            else:
-                day.states_bins_8hr[2].append(state_id)
-        else:          
-            pass
+    sort_states_in_days(state_ids,states_df,[day])
         
+@profile.stage('sort_states_in_days',rows_in='state_ids',rows_out=None)
 def sort_states_in_days(state_ids,states_df,day_list):
     """Function that goes through all relevant state_ids and sorts them to their corresponding Day objects.
     Args:
@@ -174,9 +484,43 @@ def sort_states_in_days(state_ids,states_df,day_list):
         states_df: states dataframe
         day_list: list of Day objects that represent the duration of our study
     """
-    for day in day_list:
-        which_state_ids_belong_to_day(state_ids,states_df,day)
+    if not day_list:
+        return
+    binned = bin_states_by_day(state_ids,states_df,TimeGrid.of_days(day_list))
+    profile.count('states_binned',len(binned))
+    
+    for d, group in binned.groupby('day',sort=False):
+        day = day_list[d]
+        day.states_bin.extend(group['state_id'].tolist())
+        for bin_num in range(len(day.states_bins_8hr)):
+            day.states_bins_8hr[bin_num].extend(group.loc[group['bin']==bin_num,'state_id'].tolist())
         
+def n_bins_of_days(day_list):
+    """Helper function that returns the number of bins of all days."""
+    return sum(day.n_bins for day in day_list)
+
+def n_binned_states(day_list):
+    """Helper function that returns the number of state ids in the bins of all days."""
+    return sum(len(states) for day in day_list for states in day.states_bins_8hr)
+
+def states_in_bins(day_list):
+    """Helper function that flattens the 8hr bins of all days, in order of day, bin and state.
+    Returns:
+        state_ids: array of state ids
+        day_index: array with the position of the day of each state in day_list
+        bin_index: array with the bin number of each state
+    """
+    state_ids = []
+    day_index = []
+    bin_index = []
+    for d, day in enumerate(day_list):
+        for i in range(len(day.states_bins_8hr)):
+            n = len(day.states_bins_8hr[i])
+            state_ids.extend(day.states_bins_8hr[i])
+            day_index.extend([d]*n)
+            bin_index.extend([i]*n)
+    return np.asarray(state_ids,dtype=np.int64), np.asarray(day_index,dtype=np.int64), np.asarray(bin_index,dtype=np.int64)
+
 def grab_one_day_props_for_each_day(day,props_df,states_df):
     """Function that sorts one day propagations of states to the appropriate bins. Assumes that Day objects already know which 
        state ids belong to them.
@@ -185,90 +529,133 @@ def grab_one_day_props_for_each_day(day,props_df,states_df):
         props_df: propagations dataframe
         states_df: states dataframe
     """
-    
-    one_day = 24*60*60
-    for bin_num in range(len(day.states_bins_8hr)):
-        for state_id in day.states_bins_8hr[bin_num]:
-            st_ts_series = states_df.loc[(states_df['id'] == state_id),'timestamp']
-            st_ts = st_ts_series.iloc[0].timestamp()
-            st_one_day_props = props_df.loc[
-                    props_df['timestamp']==st_ts+1*one_day,
-                    ['covariance_xx','covariance_yy','covariance_zz','Eig1','Eig2','Eig3']]
-            eig_1 = st_one_day_props['Eig1'].iloc[0]
-            eig_2 = st_one_day_props['Eig2'].iloc[0]
-            eig_3 = st_one_day_props['Eig3'].iloc[0]
-            cov_x = st_one_day_props['covariance_xx'].iloc[0]
-            cov_y = st_one_day_props['covariance_yy'].iloc[0]
-            cov_z = st_one_day_props['covariance_zz'].iloc[0]
-            day.one_day_props_1[bin_num].append(eig_1)
-            day.one_day_props_2[bin_num].append(eig_2)
-            day.one_day_props_3[bin_num].append(eig_3)
-            day.one_day_props_rms[bin_num].append(np.sqrt(cov_x+cov_y+cov_z))
+    props_for_all_days([day],props_df,states_df,horizons=(1,))
 
 def grab_two_day_props_for_each_day(day,props_df,states_df):
     """Function that sorts two day propagations of states to the appropriate bins. Assumes that Day objects already know which 
        state ids belong to them.
-    Args:
-        day: Day object
-        props_df: propagations dataframe
-        states_df: states dataframe
     """
-    one_day = 24*60*60
-    for bin_num in range(len(day.states_bins_8hr)):
-        for state_id in day.states_bins_8hr[bin_num]:
-            st_ts_series = states_df.loc[(states_df['id'] == state_id),'timestamp']
-            st_ts = st_ts_series.iloc[0].timestamp()
-            st_two_day_props = props_df.loc[
-                         props_df['timestamp']==st_ts+2*one_day,
-                         ['covariance_xx','covariance_yy','covariance_zz','Eig1','Eig2','Eig3']]
-            eig_1 = st_two_day_props['Eig1'].iloc[0]
-            eig_2 = st_two_day_props['Eig2'].iloc[0]
-            eig_3 = st_two_day_props['Eig3'].iloc[0]
-            cov_x = st_two_day_props['covariance_xx'].iloc[0]
-            cov_y = st_two_day_props['covariance_yy'].iloc[0]
-            cov_z = st_two_day_props['covariance_zz'].iloc[0]
-            day.two_day_props_1[bin_num].append(eig_1)
-            day.two_day_props_2[bin_num].append(eig_2)
-            day.two_day_props_3[bin_num].append(eig_3)
-            day.two_day_props_rms[bin_num].append(np.sqrt(cov_x+cov_y+cov_z))
+    props_for_all_days([day],props_df,states_df,horizons=(2,))
 
 def grab_three_day_props_for_each_day(day,props_df,states_df):
     """Function that sorts three day propagations of states to the appropriate bins. Assumes that Day objects already know which 
        state ids belong to them.
+    """
+    props_for_all_days([day],props_df,states_df,horizons=(3,))
+
+@profile.stage('props_for_all_days',rows_in=lambda args: n_binned_states(args['day_list'])*len(args['horizons']),
+               rows_out=None)
+def props_for_all_days(day_list,props_df,states_df,horizons=(1,2,3),tolerance=1.0,prop_index=None):
+    """Function that sorts all propagations to all days. Assumes that Day objects already know which state ids belong to 
+       them. Every (state, horizon) pair is joined to the propagation of the same state nearest to state epoch + horizon 
+       days in one pass over the propagation index.
     Args:
-        day: Day object
-        props_df: propagations dataframe
+        day_list: list of Day objects
+        props_df: propagations dataframe, or propagation summary (see summarize_props)
         states_df: states dataframe
+        horizons: days after the state epoch for which to collect propagations
+        tolerance: largest accepted difference (in seconds) between the propagation timestamp and state epoch + horizon
+        prop_index: optional prebuilt PropagationIndex of props_df
+    Returns:
+        props: PropTable of all days (see store_props), with one row per matched (day, bin, horizon, state)
+        missing: dataframe with columns 'day', 'bin', 'horizon', 'state_id' of the states without a propagation within 
+                 tolerance. Those are left out of the bins instead of stopping the run.
     """
-    one_day = 24*60*60
-    for bin_num in range(len(day.states_bins_8hr)):
-        for state_id in day.states_bins_8hr[bin_num]:
-            st_ts_series = states_df.loc[(states_df['id'] == state_id),'timestamp']
-            st_ts = st_ts_series.iloc[0].timestamp()
-            st_three_day_props = props_df.loc[
-                         props_df['timestamp']==st_ts+3*one_day,
-                         ['covariance_xx','covariance_yy','covariance_zz','Eig1','Eig2','Eig3']]
-            eig_1 = st_three_day_props['Eig1'].iloc[0]
-            eig_2 = st_three_day_props['Eig2'].iloc[0]
-            eig_3 = st_three_day_props['Eig3'].iloc[0]
-            cov_x = st_three_day_props['covariance_xx'].iloc[0]
-            cov_y = st_three_day_props['covariance_yy'].iloc[0]
-            cov_z = st_three_day_props['covariance_zz'].iloc[0]
-            day.three_day_props_1[bin_num].append(eig_1)
-            day.three_day_props_2[bin_num].append(eig_2)
-            day.three_day_props_3[bin_num].append(eig_3)
-            day.three_day_props_rms[bin_num].append(np.sqrt(cov_x+cov_y+cov_z))
-
-            
-def props_for_all_days(day_list,props_df,states_df):
-    """Function that sorts all propagations to all days."""
-    for day in day_list:
-        grab_one_day_props_for_each_day(day,props_df,states_df)
-        grab_two_day_props_for_each_day(day,props_df,states_df)
-        grab_three_day_props_for_each_day(day,props_df,states_df)
+    if prop_index is None:
+        prop_index = PropagationIndex(props_df,states_df)
+    state_ids, day_index, bin_index = states_in_bins(day_list)
+    epochs, known = state_epochs_of_ids(state_ids,states_df)
+    
+    horizons = np.asarray(horizons)
+    n = len(state_ids)
+    horizon = np.repeat(horizons,n)
+    state_h = np.tile(state_ids,len(horizons))
+    times = np.tile(epochs,len(horizons)) + np.round(horizon*NS_PER_DAY).astype(np.int64)
+    
+    positions = prop_index.nearest(state_h,times)
+    found = (positions >= 0) & np.tile(known,len(horizons))
+    found[found] = np.abs(prop_index.timestamps[positions[found]]-times[found]) <= seconds_to_ns(tolerance)
+    
+    columns = {name:getattr(prop_index,name)[positions[found]] for name in ('eig_1','eig_2','eig_3','rms')}
+    
+    day_index = np.tile(day_index,len(horizons))
+    bin_index = np.tile(bin_index,len(horizons))
+    target_ids = np.tile(target_ids_of_states(state_ids,states_df),len(horizons))
+    
+    table = PropTable(day_index[found],bin_index[found],horizon[found],target_ids[found],state_h[found],**columns)
+    missing = pd.DataFrame({'day':day_index[~found],'bin':bin_index[~found],'horizon':horizon[~found],
+                            'state_id':state_h[~found]})
+    profile.count('missing_props',len(missing))
+    profile.output_rows(len(table))
+    
+    return store_props(day_list,table), missing
         
 """Functions that perform the propagations from 'now'."""
 
+def save_index_arrays(index,directory):
+    """Helper function that writes the arrays of an index (StateIndex or PropagationIndex) as .npy files in directory."""
+    os.makedirs(directory,exist_ok=True)
+    for name in index.arrays:
+        np.save(os.path.join(directory,'{}_{}.npy'.format(index.prefix,name)),getattr(index,name))
+
+def load_index_arrays(cls,directory,mmap_mode='r'):
+    """Helper function that loads an index saved with save_index_arrays. With mmap_mode='r' the arrays are memory-mapped
+       read-only, so several processes can share them without copies."""
+    index = cls.__new__(cls)
+    for name in cls.arrays:
+        setattr(index,name,np.load(os.path.join(directory,'{}_{}.npy'.format(cls.prefix,name)),mmap_mode=mmap_mode))
+    return index
+
+class StateIndex():
+    """Class that holds the states of the relevant targets sorted by (target id, timestamp), so that the closest state 
+       of many targets to many 'now's can be found with a single as-of join.
+    """
+    prefix = 'states'
+    arrays = ('target_ids','timestamps','state_ids')
+    
+    def __init__(self,states_df,target_id_list=None):
+        if target_id_list is not None:
+            states_df = states_df[states_df['target_id'].isin(target_id_list)]
+        target_ids = states_df['target_id'].to_numpy()
+        timestamps = state_epoch_ns(states_df)
+        order = np.lexsort((timestamps,target_ids))
+        
+        self.target_ids = target_ids[order]
+        self.timestamps = timestamps[order]
+        self.state_ids = states_df['id'].to_numpy()[order]
+    
+    def save(self,directory):
+        save_index_arrays(self,directory)
+    
+    @classmethod
+    def load(cls,directory,mmap_mode='r'):
+        return load_index_arrays(cls,directory,mmap_mode)
+        
+    def closest_states(self,target_ids,nows,cutoff=7):
+        """Finds for every (target, now) pair the latest state of the target created at or before now.
+           Args:
+                target_ids: array of target ids
+                nows: array of datetimes (or int64 unix nanoseconds), broadcast against target_ids
+                cutoff: states older than cutoff days at 'now' are not considered
+           Returns:
+                closest_state_ids: float array of state ids, NaN where the target has no state within the cutoff
+        """
+        nows = np.asarray(nows)
+        if nows.dtype != np.int64:
+            nows = to_unix_ns(nows)
+        target_ids, nows = np.broadcast_arrays(np.asarray(target_ids),nows)
+        
+        positions = asof_positions(self.target_ids,self.timestamps,target_ids.ravel(),nows.ravel(),'backward')
+        found = positions >= 0
+        n_before = np.count_nonzero(found)
+        found[found] = (nows.ravel()[found] - self.timestamps[positions[found]]) < cutoff*NS_PER_DAY
+        profile.count('targets_dropped_by_cutoff',n_before-np.count_nonzero(found))
+        
+        closest_state_ids = np.full(len(positions),np.nan)
+        closest_state_ids[found] = self.state_ids[positions[found]]
+        
+        return closest_state_ids.reshape(target_ids.shape)
+
 def find_closest_state_of_target_to_now(target_id,states_df,now,cutoff=7):
     """Finds the closest state of a target to now.
        Args:
@@ -278,36 +665,11 @@ def find_closest_state_of_target_to_now(target_id,states_df,now,cutoff=7):
        Returns:
             closest_state_id: id of state closest to now
     """
-    # All state ids of target
-    state_ids_of_target = states_df.loc[states_df['target_id']==target_id,'id']
-    
-    closest_state_id = np.nan
-    
-    # timedeltas between now and state creation
-    diff = []
-    for state_id in state_ids_of_target:
-        ts = states_df.loc[(states_df['id']==state_id),'timestamp'].iloc[0]
-        if now >= ts:
-            diff.append((now-ts,state_id))
-    
-    if diff: # Account for empty list
-        # Sorted timedeltas from lowest to highest
-        diffsort = sorted(diff,key=lambda x:x[0])
-
-        # Check if closest state is within cuttof
-        if diffsort[0][0]<datetime.timedelta(days=cutoff):
-            closest_state_id = diffsort[0][1]
-    
-    return closest_state_id
+    return StateIndex(states_df,[target_id]).closest_states([target_id],now,cutoff)[0]
 
-def closest_states_of_targets(target_id_list,states_df,now):
+def closest_states_of_targets(target_id_list,states_df,now,cutoff=7):
     """Function that finds closest state ids of all target relative to 'now'."""
-    list_of_closest_states_to_now = []
-    for target_id in target_id_list:
-        closest_state_id = find_closest_state_of_target_to_now(target_id,states_df,now)
-        list_of_closest_states_to_now.append(closest_state_id)
-    
-    return list_of_closest_states_to_now
+    return list(StateIndex(states_df,target_id_list).closest_states(target_id_list,now,cutoff))
 
 def clean_list_from_nans(A):
     """Helper function that rids a list from nans. Returns list without nans."""
@@ -316,19 +678,192 @@ def clean_list_from_nans(A):
 
     return list(A)
 
-def sort_target_states_in_days(day_list,target_id_list,states_df):
-    """Function that sorts the target states into the appropriate days 8hr bins. It does not return anything.
-       For each day and each bin, it goes through the list of targets and finds exactly 1 state/target that is the closest 
-       state to that bin. By the end, the 8hr bins are populated with appropriate state ids.
+@profile.stage('sort_target_states_in_days',
+               rows_in=lambda args: len(args['target_id_list'])*n_bins_of_days(args['day_list']),rows_out=None)
+def sort_target_states_in_days(day_list,target_id_list,states_df,cutoff=7):
+    """Function that sorts the target states into the appropriate days bins. It does not return anything.
+       For each day and each bin, it finds exactly 1 state/target that is the closest state to that bin, with one as-of 
+       join over all (target, now) pairs. By the end, the bins are populated with appropriate state ids.
     """
-    for day in day_list:
-        for now_ind in range(3):
-            now = day.now[now_ind]
-            A = closest_states_of_targets(target_id_list,states_df,now)
-            A = clean_list_from_nans(A)
-            A = [int(x) for x in A]
-            day.states_bins_8hr[now_ind].extend(A)
+    grid = TimeGrid.of_days(day_list)
+    nows, day_index, bin_index = grid.bin_starts, grid.bin_day, grid.bin_number
+    target_id_list = np.asarray(target_id_list)
+    
+    index = StateIndex(states_df,target_id_list)
+    closest = index.closest_states(target_id_list[np.newaxis,:],nows[:,np.newaxis],cutoff)
+    
+    profile.count('states_binned',np.count_nonzero(~np.isnan(closest)))
+    for row in range(len(nows)):
+        A = closest[row]
+        day_list[day_index[row]].states_bins_8hr[bin_index[row]].extend(int(x) for x in A[~np.isnan(A)])
             
+def prop_eigs_and_rms(props_df):
+    """Helper function that returns the (N,3) sorted eigenvalues (the Eig columns when present) and the rms of the 
+       covariances of the propagations."""
+    if {'Eig1','Eig2','Eig3'}.issubset(props_df.columns):
+        eigs = props_df[['Eig1','Eig2','Eig3']].to_numpy(dtype=np.float64)
+    else:
+        eigs = covariance_eigenvalues(props_df)
+    rms = np.sqrt(props_df['covariance_xx'].to_numpy(dtype=np.float64)+
+                  props_df['covariance_yy'].to_numpy(dtype=np.float64)+
+                  props_df['covariance_zz'].to_numpy(dtype=np.float64))
+    return eigs, rms
+
+def summarize_props(props_df,states_df):
+    """Function that reduces the propagations to the compact table read by both pipelines, with one row per propagation:
+       'target_state_id' (int32 when the ids fit), 'offset_s' (int32 seconds from the state epoch, rounded) and the 
+       float32 'eig_1', 'eig_2', 'eig_3' and 'rms' of the covariance. Propagations of unknown states are dropped.
+    """
+    state_ids = props_df['target_state_id'].to_numpy()
+    epochs, known = state_epochs_of_ids(state_ids,states_df)
+    eigs, rms = prop_eigs_and_rms(props_df)
+    offset_ns = prop_epoch_ns(props_df) - epochs
+    
+    id_type = np.int64
+    if len(state_ids) == 0 or (state_ids.min() >= 0 and state_ids.max() <= np.iinfo(np.int32).max):
+        id_type = np.int32
+    summary = pd.DataFrame({'target_state_id':state_ids.astype(id_type),
+                            'offset_s':((offset_ns + NS_PER_SECOND//2)//NS_PER_SECOND).astype(np.int32),
+                            'eig_1':eigs[:,0].astype(np.float32),'eig_2':eigs[:,1].astype(np.float32),
+                            'eig_3':eigs[:,2].astype(np.float32),'rms':rms.astype(np.float32)})
+    return summary[known].reset_index(drop=True)
+
+def save_prop_summary(summary,path):
+    """Function that writes a propagation summary (see summarize_props) to an .npz sidecar file."""
+    np.savez(path,**{name:summary[name].to_numpy() for name in summary.columns})
+
+def load_prop_summary(path,state_ids=None):
+    """Function that reads a propagation summary sidecar file, keeping only the rows of state_ids when given."""
+    with np.load(path) as data:
+        summary = pd.DataFrame({name:data[name] for name in data.files})
+    if state_ids is not None:
+        summary = summary[summary['target_state_id'].isin(state_ids)].reset_index(drop=True)
+    return summary
+
+class PropagationIndex():
+    """Class that holds the propagations grouped by state with sorted timestamps, together with their eigenvalues and 
+       rms, so that the propagation nearest to any time can be found for many states at once.
+       Built from a propagations dataframe, or from a propagation summary (see summarize_props) together with the states
+       dataframe that gives the state epochs.
+    """
+    prefix = 'props'
+    arrays = ('state_ids','timestamps','eig_1','eig_2','eig_3','rms')
+    
+    @profile.stage('PropagationIndex',rows_in='props_df',rows_out=None)
+    def __init__(self,props_df,states_df=None):
+        state_ids = props_df['target_state_id'].to_numpy()
+        if 'offset_s' in props_df.columns:
+            if states_df is None:
+                raise ValueError("A propagation summary needs the states dataframe for the state epochs.")
+            epochs, known = state_epochs_of_ids(state_ids,states_df)
+            timestamps = epochs + props_df['offset_s'].to_numpy(dtype=np.int64)*NS_PER_SECOND
+            columns = [props_df[name].to_numpy() for name in ('eig_1','eig_2','eig_3','rms')]
+        else:
+            known = np.ones(len(props_df),dtype=bool)
+            timestamps = prop_epoch_ns(props_df)
+            eigs, rms = prop_eigs_and_rms(props_df)
+            columns = [eigs[:,0],eigs[:,1],eigs[:,2],rms]
+        order = np.flatnonzero(known)[np.lexsort((timestamps[known],state_ids[known]))]
+        
+        self.state_ids = state_ids[order]
+        self.timestamps = timestamps[order]
+        self.eig_1, self.eig_2, self.eig_3, self.rms = [column[order] for column in columns]
+    
+    def save(self,directory):
+        save_index_arrays(self,directory)
+    
+    @classmethod
+    def load(cls,directory,mmap_mode='r'):
+        return load_index_arrays(cls,directory,mmap_mode)
+        
+    def nearest(self,state_ids,times):
+        """Finds for every (state, time) pair the propagation of the state whose timestamp is nearest to time.
+           Args:
+                state_ids: array of state ids
+                times: array of int64 unix nanoseconds, same shape as state_ids
+           Returns:
+                positions: int64 array of positions in the index, -1 where the state has no propagations
+        """
+        before = asof_positions(self.state_ids,self.timestamps,state_ids,times,'backward')
+        after = asof_positions(self.state_ids,self.timestamps,state_ids,times,'forward')
+        
+        positions = before.copy()
+        use_after = after >= 0
+        both = use_after & (before >= 0)
+        use_after[both] = (self.timestamps[after[both]]-times[both]) < (times[both]-self.timestamps[before[both]])
+        positions[use_after] = after[use_after]
+        
+        return positions
+    
+    def interpolate(self,state_ids,times):
+        """Interpolates the propagation elements of every (state, time) pair between the propagations of the state 
+           just before and just after time, linearly in time and in log space (geometric), since the covariances grow 
+           about exponentially. Pairs with a non positive value on either side are interpolated linearly.
+           Args:
+                state_ids: array of state ids
+                times: array of int64 unix nanoseconds, same shape as state_ids
+           Returns:
+                eig_1, eig_2, eig_3, rms: arrays of the interpolated values, NaN where time is not bracketed by two 
+                propagations of the state (no extrapolation) and not equal to the time of one
+        """
+        before = asof_positions(self.state_ids,self.timestamps,state_ids,times,'backward')
+        after = asof_positions(self.state_ids,self.timestamps,state_ids,times,'forward')
+        
+        found = (before >= 0) & (after >= 0)
+        lo = before[found]
+        hi = after[found]
+        t_lo = self.timestamps[lo]
+        span = self.timestamps[hi] - t_lo
+        w = np.zeros(len(lo))
+        np.divide(times[found]-t_lo,span,out=w,where=span>0)
+        
+        out = []
+        for column in (self.eig_1,self.eig_2,self.eig_3,self.rms):
+            v_lo = column[lo].astype(np.float64)
+            v_hi = column[hi].astype(np.float64)
+            values = np.full(len(before),np.nan)
+            positive = (v_lo > 0) & (v_hi > 0)
+            with np.errstate(divide='ignore',invalid='ignore'):
+                values[found] = np.where(positive,np.exp((1-w)*np.log(v_lo) + w*np.log(v_hi)),(1-w)*v_lo + w*v_hi)
+            out.append(values)
+        
+        return tuple(out)
+    
+    def query(self,state_ids,nows,x=1,method='nearest'):
+        """Finds the propagation elements of the propagations closest to x days from 'now' for many states at once.
+           Args:
+                state_ids: array of state ids
+                nows: array of datetimes (or int64 unix nanoseconds)
+                x: number of days forward for the propagation, scalar or array
+                method: 'nearest' for the propagation nearest to now + x days, 'interpolate' for the values at exactly 
+                        now + x days interpolated between the propagations around it (see interpolate)
+           All three are broadcast against each other.
+           Returns:
+                eig_1, eig_2, eig_3, rms: arrays of the 3 eigenvalues and rms value of the propagation covariances, 
+                NaN where the state has no propagations
+        """
+        nows = np.asarray(nows)
+        if nows.dtype != np.int64:
+            nows = to_unix_ns(nows)
+        state_ids, nows, x = np.broadcast_arrays(np.asarray(state_ids),nows,np.asarray(x))
+        times = nows.ravel() + np.round(x.ravel()*NS_PER_DAY).astype(np.int64)
+        
+        if method == 'interpolate':
+            return tuple(values.reshape(state_ids.shape) for values in self.interpolate(state_ids.ravel(),times))
+        if method != 'nearest':
+            raise ValueError("method must be 'nearest' or 'interpolate', got {}".format(method))
+        
+        positions = self.nearest(state_ids.ravel(),times)
+        found = positions >= 0
+        
+        out = []
+        for column in (self.eig_1,self.eig_2,self.eig_3,self.rms):
+            values = np.full(len(positions),np.nan)
+            values[found] = column[positions[found]]
+            out.append(values.reshape(state_ids.shape))
+        
+        return tuple(out)
+
 def find_prop_closest_to_x_days_from_now(state_id,states_df,props_df,now,x=1):
     """Function that finds the propagation elements of the state propagation that is closest to x days from 'now'.
        Args: 
@@ -341,325 +876,257 @@ def find_prop_closest_to_x_days_from_now(state_id,states_df,props_df,now,x=1):
            3 eigenvalues and rms value of propagation covariance
            
     """
-    one_day = 24*60*60
+    prop_index = PropagationIndex(props_df.loc[props_df['target_state_id']==state_id],states_df)
+    eig_1, eig_2, eig_3, rms = prop_index.query([state_id],now,x)
     
-    # timestamp of the propagation we are looking for
-    now_plus_1d = now.timestamp() + x*one_day
+    return eig_1[0], eig_2[0], eig_3[0], rms[0]
+
+@profile.stage('per_target_x_day_props_all_days',rows_in=lambda args: n_binned_states(args['day_list']),rows_out=None)
+def per_target_x_day_props_all_days(day_list, states_df, props_df, x, prop_index=None, method='nearest'):
+    """Function that puts in the right bins of each day object the x-day-from-bin-now propagation elements. All states of
+       all bins are looked up in the propagation index with one call. A prebuilt PropagationIndex can be passed to avoid 
+       rebuilding it for every horizon. With method='interpolate' the elements are interpolated at exactly x days from 
+       the bin 'now' instead of taken from the nearest propagation (see PropagationIndex.query).
+       Returns the PropTable of all days (see store_props).
+    """
+    if prop_index is None:
+        prop_index = PropagationIndex(props_df,states_df)
     
-    # all the timestamps of propagations of the particular state
-    all_props_of_state = props_df.loc[(props_df['target_state_id']==state_id),'timestamp']
+    state_ids, day_index, bin_index = states_in_bins(day_list)
+    if len(state_ids) == 0:
+        profile.output_rows(0)
+        return store_props(day_list,PropTable.empty())
+    nows = TimeGrid.of_days(day_list).bin_start_of(day_index,bin_index)
     
-    # timedeltas between one day from now and propagation
-    diff = []
-    for prop_ts in all_props_of_state:
-        diff.append(((abs(now_plus_1d - prop_ts)),prop_ts))
-        diffsort = sorted(diff,key=lambda x:x[0])
-    # after sorting we keep the timestamp of the state whose distance from 1-day-from-now is smallest
-    timestamp_of_closest_prop = diffsort[0][1]
+    eig_1, eig_2, eig_3, rms = prop_index.query(state_ids,nows,x,method)
+    profile.count('missing_props',np.count_nonzero(np.isnan(rms)))
+    table = PropTable(day_index,bin_index,np.full(len(state_ids),x),target_ids_of_states(state_ids,states_df),
+                      state_ids,eig_1,eig_2,eig_3,rms)
+    profile.output_rows(len(table))
     
-    # selecting the propagation covariances of the state we specified above
-    # need to bound the timestamp in order to select it
-    x_day_props = props_df.loc[
-                    ((props_df['target_state_id']==state_id)&
-                    (props_df['timestamp']>=timestamp_of_closest_prop)&
-                    (props_df['timestamp']<=(timestamp_of_closest_prop+1))),
-                    ['covariance_xx','covariance_yy','covariance_zz','Eig1','Eig2','Eig3']]
+    return store_props(day_list,table)
 
-    eig_1 = x_day_props['Eig1'].iloc[0]
-    eig_2 = x_day_props['Eig2'].iloc[0]
-    eig_3 = x_day_props['Eig3'].iloc[0]
-    cov_x = x_day_props['covariance_xx'].iloc[0]
-    cov_y = x_day_props['covariance_yy'].iloc[0]
-    cov_z = x_day_props['covariance_zz'].iloc[0]
+@profile.stage('uncertainty_surface',rows_in=lambda args: n_binned_states(args['day_list'])*len(args['horizons']))
+def uncertainty_surface(day_list, states_df, props_df, horizons=np.arange(0,7.25,0.25), prop_index=None):
+    """Function that interpolates the propagation elements of the states in the bins of each day at many horizons from 
+       the bin 'now' at once (see PropagationIndex.interpolate), e.g. every 6 hours from 0 to 7 days. Assumes that Day
+       objects already know their states (see sort_target_states_in_days). The props of the days are left unchanged.
+       Returns:
+           PropTable with one row per (day, bin, horizon, state), whose prop_quantiles give the growth of the 
+           uncertainty with the horizon for every bin
+    """
+    if prop_index is None:
+        prop_index = PropagationIndex(props_df,states_df)
+    
+    state_ids, day_index, bin_index = states_in_bins(day_list)
+    nows = TimeGrid.of_days(day_list).bin_start_of(day_index,bin_index)
     
-    rms = np.sqrt(cov_x+cov_y+cov_z)
+    horizons = np.asarray(horizons,dtype=np.float64)
+    eig_1, eig_2, eig_3, rms = prop_index.query(state_ids[np.newaxis,:],nows[np.newaxis,:],horizons[:,np.newaxis],
+                                                'interpolate')
+    n = len(state_ids)
+    table = PropTable(np.tile(day_index,len(horizons)),np.tile(bin_index,len(horizons)),np.repeat(horizons,n),
+                      np.tile(target_ids_of_states(state_ids,states_df),len(horizons)),np.tile(state_ids,len(horizons)),
+                      eig_1.ravel(),eig_2.ravel(),eig_3.ravel(),rms.ravel())
     
-    return eig_1, eig_2, eig_3, rms
+    return PropTable.concat([table])
 
-def per_target_one_day_props_all_days(day_list, states_df, props_df):
+def per_target_one_day_props_all_days(day_list, states_df, props_df, prop_index=None):
     """Function that puts in the right bins of each day object the 1-day-from-bin-now propagation elements.
     """
-    for day in day_list:
-        for i in range(3):
-            all_states_in_bin = day.states_bins_8hr[i]
-            bin_now = day.now[i]
-            for state in all_states_in_bin:
-                eig_1, eig_2, eig_3, rms = find_prop_closest_to_x_days_from_now(state,states_df,props_df,bin_now,1)
-                day.one_day_props_1[i].append(eig_1)
-                day.one_day_props_2[i].append(eig_2)
-                day.one_day_props_3[i].append(eig_3)
-                day.one_day_props_rms[i].append(rms)
-
-def per_target_three_day_props_all_days(day_list, states_df, props_df):
-    """Function that puts in the right bins of each day object the 1-day-from-bin-now propagation elements.
+    return per_target_x_day_props_all_days(day_list,states_df,props_df,1,prop_index)
+
+def per_target_three_day_props_all_days(day_list, states_df, props_df, prop_index=None):
+    """Function that puts in the right bins of each day object the 3-day-from-bin-now propagation elements.
     """
-    for day in day_list:
-        for i in range(3):
-            all_states_in_bin = day.states_bins_8hr[i]
-            bin_now = day.now[i]
-            for state in all_states_in_bin:
-                eig_1, eig_2, eig_3, rms = find_prop_closest_to_x_days_from_now(state,states_df,props_df,bin_now,3)
-                day.three_day_props_1[i].append(eig_1)
-                day.three_day_props_2[i].append(eig_2)
-                day.three_day_props_3[i].append(eig_3)
-                day.three_day_props_rms[i].append(rms)
+    return per_target_x_day_props_all_days(day_list,states_df,props_df,3,prop_index)
 
 """Common Functions"""
         
-def percentiles_1d_prop(day_list):
-    """Function that return percentiles of one day propagation covariances from days objects. Assumes that Day objects already 
-      contain their propagations.
+METRICS = ('eig_1','eig_2','eig_3','rms')
+
+def collect_props(day_list):
+    """Function that gathers the props of all days in one PropTable, with 'day' being the position in day_list."""
+    return PropTable.concat([day.props.with_day(d) for d, day in enumerate(day_list)])
+
+def grouped_quantiles(groups,values,n_groups,quantiles):
+    """Helper function that computes quantiles (0-100) of values per group number (0 <= groups < n_groups) with one sort.
+       NaN values are ignored, groups without values get NaN. Interpolation is linear as in np.percentile.
+    Returns:
+        array of shape (n_groups, len(quantiles))
     """
-    pr110 = []
-    pr125 = []
-    pr150 = []
-    pr175 = []
-    pr195 = []
+    valid = ~np.isnan(values)
+    groups = groups[valid]
+    values = values[valid]
     
-    pr210 = []
-    pr225 = []
-    pr250 = []
-    pr275 = []
-    pr295 = []
+    order = np.lexsort((values,groups))
+    values = values[order]
+    counts = np.bincount(groups,minlength=n_groups)
+    starts = np.cumsum(counts) - counts
     
-    pr310 = []
-    pr325 = []
-    pr350 = []
-    pr375 = []
-    pr395 = []
+    result = np.full((n_groups,len(quantiles)),np.nan)
+    has_values = counts > 0
+    n = counts[has_values]
+    first = starts[has_values]
+    for j, q in enumerate(quantiles):
+        pos = q/100*(n-1)
+        lo = np.floor(pos).astype(np.int64)
+        hi = np.minimum(lo+1,n-1)
+        frac = pos - lo
+        result[has_values,j] = values[first+lo] + frac*(values[first+hi]-values[first+lo])
     
-    prrms10 = []
-    prrms25 = []
-    prrms50 = []
-    prrms75 = []
-    prrms95 = []
+    return result
 
+def prop_groups(table,day_list=None,horizons=None,metrics=METRICS,membership=None,return_rows=False):
+    """Helper function that numbers the (day, bin, horizon, metric) groups, or (population, day, bin, horizon, metric)
+       groups with membership, of the values of a PropTable (see prop_quantiles for the other arguments).
+    Args:
+        return_rows: also return the row of the table of every value
+    Returns:
+        index: MultiIndex of all groups, in order of group number
+        groups: group number of every value
+        values: the metric values of the rows of the table, one block per metric
+        rows: row of the table of every value, only with return_rows
+    """
+    if day_list is not None:
+        days = np.arange(len(day_list))
+        n_bins = max([day.n_bins for day in day_list]+[0])
+    else:
+        days = np.unique(table.day)
+        n_bins = int(table.bin.max())+1 if len(table) else 0
+    if horizons is None:
+        horizons = np.unique(table.horizon)
+    horizons = np.sort(np.asarray(horizons,dtype=np.float64))
     
-    for day in day_list:
-        for i in range(len(day.one_day_props_1)):
-            if day.one_day_props_1[i]:
-                pr110.append(np.percentile(day.one_day_props_1[i],10))
-                pr125.append(np.percentile(day.one_day_props_1[i],25))
-                pr150.append(np.percentile(day.one_day_props_1[i],50))
-                pr175.append(np.percentile(day.one_day_props_1[i],75))
-                pr195.append(np.percentile(day.one_day_props_1[i],95))
-            else:
-                pr110.append(np.nan)
-                pr125.append(np.nan)
-                pr150.append(np.nan)
-                pr175.append(np.nan)
-                pr195.append(np.nan)
-            if day.one_day_props_2[i]:    
-                pr210.append(np.percentile(day.one_day_props_2[i],10))
-                pr225.append(np.percentile(day.one_day_props_2[i],25))
-                pr250.append(np.percentile(day.one_day_props_2[i],50))
-                pr275.append(np.percentile(day.one_day_props_2[i],75))
-                pr295.append(np.percentile(day.one_day_props_2[i],95))
-            else:
-                pr210.append(np.nan)
-                pr225.append(np.nan)
-                pr250.append(np.nan)
-                pr275.append(np.nan)
-                pr295.append(np.nan)
-            if day.one_day_props_3[i]:
-                pr310.append(np.percentile(day.one_day_props_3[i],10))
-                pr325.append(np.percentile(day.one_day_props_3[i],25))
-                pr350.append(np.percentile(day.one_day_props_3[i],50))
-                pr375.append(np.percentile(day.one_day_props_3[i],75))
-                pr395.append(np.percentile(day.one_day_props_3[i],95))
-            else:
-                pr310.append(np.nan)
-                pr325.append(np.nan)
-                pr350.append(np.nan)
-                pr375.append(np.nan)
-                pr395.append(np.nan)
-            if day.one_day_props_rms[i]:
-                prrms10.append(np.percentile(day.one_day_props_rms[i],10))
-                prrms25.append(np.percentile(day.one_day_props_rms[i],25))
-                prrms50.append(np.percentile(day.one_day_props_rms[i],50))
-                prrms75.append(np.percentile(day.one_day_props_rms[i],75))
-                prrms95.append(np.percentile(day.one_day_props_rms[i],95))
-            else:
-                prrms10.append(np.nan)
-                prrms25.append(np.nan)
-                prrms50.append(np.nan)
-                prrms75.append(np.nan)
-                prrms95.append(np.nan)
-            
-    return pr110,pr125,pr150,pr175,pr195,\
-            pr210,pr225,pr250,pr275,pr295,\
-            pr310,pr325,pr350,pr375,pr395,\
-            prrms10,prrms25,prrms50,prrms75,prrms95
+    # rows of the table and the population of each, a row is repeated for every population of its target
+    rows = np.arange(len(table))
+    population = np.zeros(len(table),dtype=np.int64)
+    levels = [days,np.arange(n_bins),horizons,list(metrics)]
+    names = ['day','bin','horizon','metric']
+    if membership is not None:
+        populations = pd.unique(membership['population'])
+        tagged = pd.DataFrame({'target_id':membership['target_id'].to_numpy(),
+                               'population':pd.Index(populations).get_indexer(membership['population'])})
+        joined = pd.DataFrame({'row':rows,'target_id':table.target_id}).merge(tagged,on='target_id')
+        rows = joined['row'].to_numpy()
+        population = joined['population'].to_numpy()
+        levels = [list(populations)] + levels
+        names = ['population'] + names
+    
+    index = pd.MultiIndex.from_product(levels,names=names)
+    
+    # group number of every row, in the order of the index
+    day = table.day[rows]
+    horizon = table.horizon[rows]
+    h_ind = np.searchsorted(horizons,horizon)
+    keep = (h_ind < len(horizons)) & np.isin(day,days)
+    keep[keep] = horizons[h_ind[keep]] == horizon[keep]
+    d_ind = np.searchsorted(days,day[keep])
+    row_group = (((population[keep]*len(days) + d_ind)*n_bins + table.bin[rows][keep])*len(horizons) + 
+                 h_ind[keep])*len(metrics)
+    
+    groups = np.concatenate([row_group+m for m in range(len(metrics))])
+    values = np.concatenate([getattr(table,metric)[rows][keep] for metric in metrics])
+    if return_rows:
+        return index, groups, values, np.tile(rows[keep],len(metrics))
+    return index, groups, values
 
-def percentiles_2d_prop(day_list):
-    """Function that return percentiles of two day propagation covariances from days objects. Assumes that Day objects already 
-      contain their propagations.
+@profile.stage('prop_quantiles',rows_in='table')
+def prop_quantiles(table,quantiles=(10,25,50,75,95),day_list=None,horizons=None,metrics=METRICS,membership=None):
+    """Function that computes quantiles of the propagation elements of every (day, bin, horizon, metric) in one grouped, 
+       vectorized pass. NaN values are ignored, groups without values get NaN. Interpolation is linear as in np.percentile.
+    Args:
+        table: PropTable, e.g. as returned by props_for_all_days or per_target_x_day_props_all_days
+        quantiles: percentiles (0-100) to compute
+        day_list: optional list of Day objects the table was built for. When given, every day and bin of the list is 
+                  in the output, also the ones without any propagation.
+        horizons: horizons to report (default: all horizons of the table)
+        metrics: columns of the table to compute quantiles of
+        membership: optional dataframe with columns 'target_id' and 'population' (see population_membership). When 
+                    given, the quantiles are computed for every population in the same pass.
+    Returns:
+        dataframe indexed by (day, bin, horizon, metric), or (population, day, bin, horizon, metric) with membership, 
+        with one column per quantile
     """
-    pr110 = []
-    pr125 = []
-    pr150 = []
-    pr175 = []
-    pr195 = []
+    quantiles = np.asarray(quantiles,dtype=np.float64)
+    index, groups, values = prop_groups(table,day_list,horizons,metrics,membership)
+    result = grouped_quantiles(groups,values,len(index),quantiles)
     
-    pr210 = []
-    pr225 = []
-    pr250 = []
-    pr275 = []
-    pr295 = []
+    return pd.DataFrame(result,index=index,columns=pd.Index(quantiles,name='quantile'))
+
+def grouped_top_k(groups,values,n_groups,k):
+    """Helper function that finds the k largest values of every group number (0 <= groups < n_groups) with a partial 
+       selection (np.argpartition) inside each group instead of a sort of all values. NaN values are ignored.
+    Returns:
+        int64 array of shape (n_groups, k) with the positions in values of the k largest values of each group, from 
+        the largest down, -1 where a group has less than k values
+    """
+    valid = np.flatnonzero(~np.isnan(values))
+    order = valid[np.argsort(groups[valid],kind='stable')]
+    bounds = np.searchsorted(groups[order],np.arange(n_groups+1))
     
-    pr310 = []
-    pr325 = []
-    pr350 = []
-    pr375 = []
-    pr395 = []
+    top = np.full((n_groups,k),-1,dtype=np.int64)
+    for g in np.flatnonzero(np.diff(bounds)):
+        members = order[bounds[g]:bounds[g+1]]
+        if len(members) > k:
+            members = members[np.argpartition(values[members],len(members)-k)[len(members)-k:]]
+        members = members[np.argsort(-values[members],kind='stable')]
+        top[g,:len(members)] = members
+    return top
+
+@profile.stage('prop_top_k',rows_in='table')
+def prop_top_k(table,k=10,day_list=None,horizons=None,metrics=METRICS,membership=None):
+    """Function that finds the targets with the k largest propagation elements of every (day, bin, horizon, metric), 
+       to drill down into the quantiles of prop_quantiles (same arguments and groups). NaN values are ignored.
+    Returns:
+        dataframe indexed by (day, bin, horizon, metric, rank), or with the population level first with membership, 
+        with columns 'value', 'target_id' and 'state_id'. Rank 0 is the largest value, groups with less than k values 
+        have less rows.
+    """
+    index, groups, values, rows = prop_groups(table,day_list,horizons,metrics,membership,return_rows=True)
+    top = grouped_top_k(groups,values,len(index),k)
     
-    prrms10 = []
-    prrms25 = []
-    prrms50 = []
-    prrms75 = []
-    prrms95 = []
+    group, rank = np.nonzero(top >= 0)
+    positions = top[group,rank]
+    top_index = pd.MultiIndex.from_arrays([index.get_level_values(name)[group] for name in index.names]+[rank],
+                                          names=list(index.names)+['rank'])
+    return pd.DataFrame({'value':values[positions],'target_id':table.target_id[rows[positions]],
+                         'state_id':table.state_id[rows[positions]]},index=top_index)
 
+@profile.stage('percentiles_x_day_prop',rows_in=lambda args: sum(len(day.props) for day in args['day_list']),
+               rows_out=lambda result: len(result[0]))
+def percentiles_x_day_prop(day_list,x):
+    """Function that return percentiles of x day propagation covariances from days objects, as lists over (day, bin) in the
+       order 10, 25, 50, 75, 95 for the max, mid and min eigenvalues and the rms. Assumes that Day objects already contain
+       their propagations.
+    """
+    quantiles = (10,25,50,75,95)
+    table = prop_quantiles(collect_props(day_list),quantiles,day_list,horizons=[x])
     
-    for day in day_list:
-        for i in range(len(day.two_day_props_1)):
-            if day.two_day_props_1[i]:
-                pr110.append(np.percentile(day.two_day_props_1[i],10))
-                pr125.append(np.percentile(day.two_day_props_1[i],25))
-                pr150.append(np.percentile(day.two_day_props_1[i],50))
-                pr175.append(np.percentile(day.two_day_props_1[i],75))
-                pr195.append(np.percentile(day.two_day_props_1[i],95))
-            else:
-                pr110.append(np.nan)
-                pr125.append(np.nan)
-                pr150.append(np.nan)
-                pr175.append(np.nan)
-                pr195.append(np.nan)
-            if day.two_day_props_2[i]:    
-                pr210.append(np.percentile(day.two_day_props_2[i],10))
-                pr225.append(np.percentile(day.two_day_props_2[i],25))
-                pr250.append(np.percentile(day.two_day_props_2[i],50))
-                pr275.append(np.percentile(day.two_day_props_2[i],75))
-                pr295.append(np.percentile(day.two_day_props_2[i],95))
-            else:
-                pr210.append(np.nan)
-                pr225.append(np.nan)
-                pr250.append(np.nan)
-                pr275.append(np.nan)
-                pr295.append(np.nan)
-            if day.two_day_props_3[i]:
-                pr310.append(np.percentile(day.two_day_props_3[i],10))
-                pr325.append(np.percentile(day.two_day_props_3[i],25))
-                pr350.append(np.percentile(day.two_day_props_3[i],50))
-                pr375.append(np.percentile(day.two_day_props_3[i],75))
-                pr395.append(np.percentile(day.two_day_props_3[i],95))
-            else:
-                pr310.append(np.nan)
-                pr325.append(np.nan)
-                pr350.append(np.nan)
-                pr375.append(np.nan)
-                pr395.append(np.nan)
-            if day.two_day_props_rms[i]:
-                prrms10.append(np.percentile(day.two_day_props_rms[i],10))
-                prrms25.append(np.percentile(day.two_day_props_rms[i],25))
-                prrms50.append(np.percentile(day.two_day_props_rms[i],50))
-                prrms75.append(np.percentile(day.two_day_props_rms[i],75))
-                prrms95.append(np.percentile(day.two_day_props_rms[i],95))
-            else:
-                prrms10.append(np.nan)
-                prrms25.append(np.nan)
-                prrms50.append(np.nan)
-                prrms75.append(np.nan)
-                prrms95.append(np.nan)
-            
-    return pr110,pr125,pr150,pr175,pr195,\
-            pr210,pr225,pr250,pr275,pr295,\
-            pr310,pr325,pr350,pr375,pr395,\
-            prrms10,prrms25,prrms50,prrms75,prrms95
+    percentiles = []
+    for metric in METRICS:
+        block = table.xs((float(x),metric),level=('horizon','metric'))
+        for q in quantiles:
+            percentiles.append(block[float(q)].tolist())
+    return tuple(percentiles)
 
-def percentiles_3d_prop(day_list):
+def percentiles_1d_prop(day_list):
+    """Function that return percentiles of one day propagation covariances from days objects. Assumes that Day objects already 
+      contain their propagations.
+    """
+    return percentiles_x_day_prop(day_list,1)
+
+def percentiles_2d_prop(day_list):
     """Function that return percentiles of two day propagation covariances from days objects. Assumes that Day objects already 
       contain their propagations.
     """
-    pr110 = []
-    pr125 = []
-    pr150 = []
-    pr175 = []
-    pr195 = []
-    
-    pr210 = []
-    pr225 = []
-    pr250 = []
-    pr275 = []
-    pr295 = []
-    
-    pr310 = []
-    pr325 = []
-    pr350 = []
-    pr375 = []
-    pr395 = []
-    
-    prrms10 = []
-    prrms25 = []
-    prrms50 = []
-    prrms75 = []
-    prrms95 = []
-    
-    for day in day_list:
-        for i in range(len(day.three_day_props_1)):
-            if day.three_day_props_1[i]:
-                pr110.append(np.percentile(day.three_day_props_1[i],10))
-                pr125.append(np.percentile(day.three_day_props_1[i],25))
-                pr150.append(np.percentile(day.three_day_props_1[i],50))
-                pr175.append(np.percentile(day.three_day_props_1[i],75))
-                pr195.append(np.percentile(day.three_day_props_1[i],95))
-            else:
-                pr110.append(np.nan)
-                pr125.append(np.nan)
-                pr150.append(np.nan)
-                pr175.append(np.nan)
-                pr195.append(np.nan)
-            if day.three_day_props_2[i]:    
-                pr210.append(np.percentile(day.three_day_props_2[i],10))
-                pr225.append(np.percentile(day.three_day_props_2[i],25))
-                pr250.append(np.percentile(day.three_day_props_2[i],50))
-                pr275.append(np.percentile(day.three_day_props_2[i],75))
-                pr295.append(np.percentile(day.three_day_props_2[i],95))
-            else:
-                pr210.append(np.nan)
-                pr225.append(np.nan)
-                pr250.append(np.nan)
-                pr275.append(np.nan)
-                pr295.append(np.nan)
-            if day.three_day_props_3[i]:
-                pr310.append(np.percentile(day.three_day_props_3[i],10))
-                pr325.append(np.percentile(day.three_day_props_3[i],25))
-                pr350.append(np.percentile(day.three_day_props_3[i],50))
-                pr375.append(np.percentile(day.three_day_props_3[i],75))
-                pr395.append(np.percentile(day.three_day_props_3[i],95))
-            else:
-                pr310.append(np.nan)
-                pr325.append(np.nan)
-                pr350.append(np.nan)
-                pr375.append(np.nan)
-                pr395.append(np.nan)
-            if day.three_day_props_rms[i]:
-                prrms10.append(np.percentile(day.three_day_props_rms[i],10))
-                prrms25.append(np.percentile(day.three_day_props_rms[i],25))
-                prrms50.append(np.percentile(day.three_day_props_rms[i],50))
-                prrms75.append(np.percentile(day.three_day_props_rms[i],75))
-                prrms95.append(np.percentile(day.three_day_props_rms[i],95))
-            else:
-                prrms10.append(np.nan)
-                prrms25.append(np.nan)
-                prrms50.append(np.nan)
-                prrms75.append(np.nan)
-                prrms95.append(np.nan)
-            
-    return pr110,pr125,pr150,pr175,pr195,\
-            pr210,pr225,pr250,pr275,pr295,\
-            pr310,pr325,pr350,pr375,pr395,\
-            prrms10,prrms25,prrms50,prrms75,prrms95
+    return percentiles_x_day_prop(day_list,2)
 
+def percentiles_3d_prop(day_list):
+    """Function that return percentiles of three day propagation covariances from days objects. Assumes that Day objects already 
+      contain their propagations.
+    """
+    return percentiles_x_day_prop(day_list,3)
 
 def xtick_labels(day_list):
     """Function that return all the labels to be used for plotting for the relevant study range.
@@ -681,30 +1148,43 @@ def x_plottings(percentile_list):
     x_t = [i for i in range(len(percentile_list)+1)]
     return xs, x_t
 
-def add_eig_columns_to_props(props_df):
-    """Function that adds 3 principal eigenvectors of the covariance matrix to the propagations dataframe"""
-    xx = props_df["covariance_xx"].values
-    xy = props_df["covariance_xy"].values
-    xz = props_df["covariance_xz"].values
-    yy = props_df["covariance_yy"].values
-    yz = props_df["covariance_yz"].values
-    zz = props_df["covariance_zz"].values
-    
-    A = np.stack((xx,xy,xz,xy,yy,yz,xz,yz,zz),axis=1)
-    
-    eig1 = []
-    eig2 = []
-    eig3 = []
-    for i in range(len(props_df)):
-        B = np.reshape(A[i,:],(3,3))
-        eigs_B = np.linalg.eigvals(B)
-        eigs_B = sorted(eigs_B,reverse=True)
-        eig1.append(eigs_B[0])
-        eig2.append(eigs_B[1])
-        eig3.append(eigs_B[2])
-    
-    props_df["Eig1"] = eig1
-    props_df["Eig2"] = eig2
-    props_df["Eig3"] = eig3
-    
-    return props_df
\ No newline at end of file
+@profile.stage('covariance_eigenvalues',rows_in='props_df')
+def covariance_eigenvalues(props_df,chunk_size=100000):
+    """Function that computes the 3 eigenvalues of the position covariance of every propagation in one batched pass.
+    Args:
+        props_df: propagations dataframe
+        chunk_size: number of propagations whose (3,3) matrices are stacked and solved together. Bounds the memory
+                    used by the temporary stacks.
+    Returns:
+        eigs: (N,3) array with the eigenvalues of each row sorted from largest to smallest. Rows with NaN or inf 
+              covariance elements get NaN eigenvalues. Non positive definite rows keep their (negative) eigenvalues.
+    """
+    cov = props_df[["covariance_xx","covariance_xy","covariance_xz",
+                    "covariance_yy","covariance_yz","covariance_zz"]].to_numpy(dtype=np.float64)
+    n = len(cov)
+    eigs = np.full((n,3),np.nan)
+    
+    # index of each element of the (3,3) matrix in the 6 covariance columns
+    sym = [0,1,2,1,3,4,2,4,5]
+    
+    for start in range(0,n,chunk_size):
+        block = cov[start:start+chunk_size]
+        finite = np.isfinite(block).all(axis=1)
+        if not finite.any():
+            continue
+        B = block[finite][:,sym].reshape(-1,3,3)
+        # eigvalsh returns ascending eigenvalues of symmetric matrices, flip them to descending order
+        eigs[start:start+chunk_size][finite] = np.linalg.eigvalsh(B)[:,::-1]
+    
+    return eigs
+
+@profile.stage('add_eig_columns_to_props',rows_in='props_df')
+def add_eig_columns_to_props(props_df,chunk_size=100000):
+    """Function that adds 3 principal eigenvalues of the covariance matrix to the propagations dataframe"""
+    eigs = covariance_eigenvalues(props_df,chunk_size)
+    
+    props_df["Eig1"] = eigs[:,0]
+    props_df["Eig2"] = eigs[:,1]
+    props_df["Eig3"] = eigs[:,2]
+    
+    return props_df
@@ -0,0 +1,120 @@
+"""Functions that keep SLI results up to date incrementally, dump after dump.
+
+The per (day, bin, horizon, state) propagation elements are persisted in a directory together with a watermark (the 
+newest state timestamp processed). A new dump only recomputes the days from the watermark day, minus the days whose 
+horizons were still open, onwards.
+"""
+import datetime
+import json
+import os
+
+import numpy as np
+
+import SLI_functions as sli
+
+TABLE_FILE = 'props.npz'
+META_FILE = 'meta.json'
+
+def save_results(store_dir,day_list,table,meta):
+    """Function that persists a PropTable built for day_list and its metadata in store_dir."""
+    os.makedirs(store_dir,exist_ok=True)
+    date_keys = np.asarray([sli.date_key_of_day(day) for day in day_list],dtype=np.int64)
+    columns = {name:getattr(table,name) for name in sli.PropTable.columns}
+    columns['date_key'] = date_keys[table.day] if len(table) else np.zeros(0,dtype=np.int64)
+    
+    np.savez(os.path.join(store_dir,TABLE_FILE),**columns)
+    with open(os.path.join(store_dir,META_FILE),'w') as f:
+        json.dump(meta,f)
+
+def load_results(store_dir):
+    """Function that loads persisted results.
+    Returns:
+        date_keys: array with the date key (see sli.date_key_of_day) of every row of the table
+        table: PropTable
+        meta: dictionary of metadata ('mode', 'horizons', 'cutoff', 'bin_hours', 'watermark'), None when nothing is 
+              stored yet
+    """
+    if not os.path.exists(os.path.join(store_dir,META_FILE)):
+        return np.zeros(0,dtype=np.int64), sli.PropTable.empty(), None
+    with open(os.path.join(store_dir,META_FILE)) as f:
+        meta = json.load(f)
+    with np.load(os.path.join(store_dir,TABLE_FILE)) as data:
+        table = sli.PropTable(*[data[name] for name in sli.PropTable.columns])
+        date_keys = data['date_key']
+    return date_keys, table, meta
+
+def date_of_key(key):
+    """Helper function that turns a date key (year*10000 + month*100 + day) into a datetime.date."""
+    return datetime.date(int(key)//10000,int(key)//100%100,int(key)%100)
+
+def update_sli(store_dir,targets_df,states_df,props_df,mode='now',horizons=(1,3),cutoff=7,tolerance=1.0,
+               bin_hours=8):
+    """Function that brings the SLI results persisted in store_dir up to date with a new dump.
+       Only days from (watermark day - max(horizons) days) onwards are recomputed, using the states created in them (or,
+       in 'now' mode, within cutoff days before them) and their propagations. Older days are taken from the store.
+       The study ends, as in sli.create_day_list, the day before the newest state.
+    Args:
+        store_dir: directory of the persisted results (created on the first run)
+        targets_df: filtered targets dataframe (only relevant targets)
+        states_df: states dataframe
+        props_df: propagations dataframe
+        mode: 'now' for propagations from the 8hr 'now's, 'epoch' for propagations from state epoch
+        horizons: horizons (in days) of the propagations
+        cutoff: in 'now' mode, states older than cutoff days are not used
+        tolerance: in 'epoch' mode, see sli.props_for_all_days
+        bin_hours: width of the bins of the days, see sli.Day
+    Returns:
+        day_list: list of Day objects of all stored days, with their props
+        table: PropTable of all stored days
+    """
+    date_keys, table, meta = load_results(store_dir)
+    params = {'mode':mode,'horizons':list(horizons),'cutoff':cutoff,'bin_hours':bin_hours}
+    if meta is not None and any(meta.get(name) != value for name, value in params.items()):
+        raise ValueError("The results in {} were computed with other parameters: {}".format(store_dir,meta))
+    
+    state_ns = sli.state_epoch_ns(states_df)
+    watermark = int(state_ns.max())
+    if meta is None:
+        first_date = sli.date_of_unix_ns(state_ns.min())
+    else:
+        watermark = max(watermark,meta['watermark'])
+        first_date = sli.date_of_unix_ns(meta['watermark']) - datetime.timedelta(days=int(np.ceil(max(horizons))))
+    end_date = sli.date_of_unix_ns(watermark)
+    
+    # states that can end up in the recomputed days, and their propagations
+    lookback = cutoff if mode == 'now' else 0
+    first_ns = sli.to_unix_ns(datetime.datetime.combine(first_date,datetime.time()))[0]
+    new_states_df = states_df[state_ns >= first_ns - lookback*sli.NS_PER_DAY]
+    new_props_df = props_df[props_df['target_state_id'].isin(new_states_df['id'])]
+    
+    new_days = sli.create_day_list_between(first_date,end_date,bin_hours)
+    prop_index = sli.PropagationIndex(new_props_df,new_states_df)
+    if mode == 'now':
+        sli.sort_target_states_in_days(new_days,targets_df['id'].to_numpy(),new_states_df,cutoff)
+        for x in horizons:
+            sli.per_target_x_day_props_all_days(new_days,new_states_df,new_props_df,x,prop_index)
+    else:
+        state_ids = new_states_df.loc[new_states_df['target_id'].isin(targets_df['id']),'id'].to_list()
+        sli.sort_states_in_days(state_ids,new_states_df,new_days)
+        sli.props_for_all_days(new_days,new_props_df,new_states_df,horizons,tolerance,prop_index)
+    
+    # keep stored rows of days before the recomputed ones
+    first_key = first_date.year*10000 + first_date.month*100 + first_date.day
+    kept = date_keys < first_key
+    start_date = date_of_key(date_keys[kept].min()) if kept.any() else first_date
+    day_list = sli.create_day_list_between(start_date,max(end_date,start_date),bin_hours)
+    day_keys = np.asarray([sli.date_key_of_day(day) for day in day_list],dtype=np.int64)
+    
+    old = table[kept]
+    old.day = np.searchsorted(day_keys,date_keys[kept]).astype(np.int32)
+    offset = len(day_list) - len(new_days)
+    new = sli.collect_props(new_days)
+    new.day = (new.day + offset).astype(np.int32)
+    for day, new_day in zip(day_list[offset:],new_days):
+        day.states_bin = new_day.states_bin
+        day.states_bins_8hr = new_day.states_bins_8hr
+    
+    table = sli.store_props(day_list,sli.PropTable.concat([old,new]))
+    save_results(store_dir,day_list,table,dict(params,watermark=watermark))
+    
+    return day_list, table
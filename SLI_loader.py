@@ -0,0 +1,222 @@
+"""Functions that load the relevant parts of an SLI dump (HDF5 file with 'targets', 'states' and 'propagations' keys)."""
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import SLI_functions as sli
+import SLI_profile as profile
+
+PROP_COLUMNS = ['target_state_id','timestamp',
+                'covariance_xx','covariance_xy','covariance_xz','covariance_yy','covariance_yz','covariance_zz']
+
+def read_rows_with_ids(store,key,id_column,ids,columns=None,chunksize=1000000):
+    """Function that reads from an open HDFStore only the rows of a key whose id_column is in ids.
+    Args:
+        store: open pd.HDFStore
+        key: key of the dump to read
+        id_column: column the rows are filtered on
+        ids: ids to keep
+        columns: columns to read (default: all)
+        chunksize: number of rows read at a time
+    Keys written in table format are read chunk by chunk, with only the requested columns, and when id_column is a data 
+    column the [min(ids), max(ids)] range is pushed down to the file as a where condition. Keys in fixed format can only 
+    be read whole, so they are filtered after reading.
+    Returns:
+        dataframe with the selected rows and columns
+    """
+    ids = pd.unique(np.asarray(ids))
+    if columns is not None and id_column not in columns:
+        read_columns = list(columns) + [id_column]
+    else:
+        read_columns = columns
+    
+    storer = store.get_storer(key)
+    if not storer.is_table:
+        df = store.select(key)
+        df = df.loc[df[id_column].isin(ids)]
+        return df if columns is None else df[list(columns)]
+    
+    where = None
+    if len(ids) and id_column in (storer.data_columns or []):
+        where = '({col} >= {lo}) & ({col} <= {hi})'.format(col=id_column,lo=ids.min(),hi=ids.max())
+    
+    parts = []
+    for chunk in store.select(key,where=where,columns=read_columns,chunksize=chunksize):
+        parts.append(chunk.loc[chunk[id_column].isin(ids)])
+    if parts:
+        df = pd.concat(parts)
+    else:
+        df = store.select(key,where=where,columns=read_columns,start=0,stop=0)
+    
+    return df if columns is None else df[list(columns)]
+
+def iter_key_chunks(store,key,columns=None,chunksize=1000000):
+    """Function that yields a key of an open HDFStore as dataframes of at most chunksize rows with the requested columns
+       (default: all). Keys in fixed format can only be read whole, so they come as a single dataframe.
+    """
+    if store.get_storer(key).is_table:
+        yield from store.select(key,columns=columns,chunksize=chunksize)
+    else:
+        df = store.select(key)
+        yield df if columns is None else df[list(columns)]
+
+def prop_summary_path(path):
+    """Function that returns the path of the propagation summary sidecar file of a dump."""
+    return os.path.splitext(path)[0] + '.props.npz'
+
+def write_prop_summary(path,chunksize=1000000):
+    """Function that builds the propagation summary (see sli.summarize_props) of all the propagations of a dump, reading 
+       them chunk by chunk when the key is in table format, and writes it next to the dump. Returns the sidecar path.
+    """
+    with pd.HDFStore(path,mode='r') as store:
+        states_df = store.select('states')
+        parts = [sli.summarize_props(chunk,states_df) 
+                 for chunk in iter_key_chunks(store,'propagations',PROP_COLUMNS,chunksize)]
+    
+    summary_path = prop_summary_path(path)
+    sli.save_prop_summary(pd.concat(parts,ignore_index=True) if parts else 
+                          sli.summarize_props(pd.DataFrame(columns=PROP_COLUMNS),states_df),summary_path)
+    return summary_path
+
+def select_targets(targets_df,type_id=2,min_apogee=500,max_perigee=650,populations=None):
+    """Function that keeps the targets of the population filter, or of any of the populations when given."""
+    if populations is None:
+        return sli.filter_targets(targets_df,type_id,min_apogee,max_perigee)
+    return targets_df[targets_df['id'].isin(sli.population_membership(targets_df,populations)['target_id'])]
+
+@profile.stage('load_dump',rows_out=lambda result: len(result[1]))
+def load_dump(path,type_id=2,min_apogee=500,max_perigee=650,chunksize=1000000,populations=None,use_summary=False,
+              load_props=True):
+    """Function that loads the targets of a population from a dump together with only their states and propagations.
+       Targets are read first and filtered (see sli.filter_targets), then only the states of those targets and the 
+       propagation rows and covariance columns of those states are read.
+    Args:
+        path: path of the dump_<timestamp>.h5 file
+        type_id, min_apogee, max_perigee: population filter, see sli.filter_targets
+        chunksize: number of rows read at a time from table format keys
+        populations: optional list of sli.Population objects. When given, the targets of all of them are loaded instead
+                     of the single population filter.
+        use_summary: if True, props_df is the propagation summary of the loaded states (see sli.summarize_props), read 
+                     from the sidecar file of the dump, which is built first when missing (see write_prop_summary)
+        load_props: if False, the propagations are not read and props_df is None, for runs that look them up in a 
+                    propagation store (see SLI_store)
+    Returns:
+        targets_df, states_df, props_df, with their times normalized (see sli.normalize_times)
+    """
+    with pd.HDFStore(path,mode='r') as store:
+        targets_df = select_targets(store.select('targets'),type_id,min_apogee,max_perigee,populations)
+        states_df = read_rows_with_ids(store,'states','target_id',targets_df['id'],chunksize=chunksize)
+        props_df = None
+        if load_props and not use_summary:
+            props_df = read_rows_with_ids(store,'propagations','target_state_id',states_df['id'],
+                                          columns=PROP_COLUMNS,chunksize=chunksize)
+    
+    if load_props and use_summary:
+        summary_path = prop_summary_path(path)
+        if not os.path.exists(summary_path):
+            write_prop_summary(path,chunksize)
+        states_df, _ = sli.normalize_times(states_df.reset_index(drop=True))
+        return targets_df, states_df, sli.load_prop_summary(summary_path,states_df['id'])
+    
+    if props_df is not None:
+        props_df = props_df.reset_index(drop=True)
+    states_df, props_df = sli.normalize_times(states_df.reset_index(drop=True),props_df)
+    return targets_df, states_df, props_df
+
+PROP_KEY = ['target_state_id','timestamp']
+
+def read_dump_rows(path,target_ids,chunksize=1000000):
+    """Function that reads from a dump the states of target_ids and the propagations of those states."""
+    with pd.HDFStore(path,mode='r') as store:
+        states_df = read_rows_with_ids(store,'states','target_id',target_ids,chunksize=chunksize)
+        props_df = read_rows_with_ids(store,'propagations','target_state_id',states_df['id'],
+                                      columns=PROP_COLUMNS,chunksize=chunksize)
+    return states_df, props_df
+
+@profile.stage('load_dumps',rows_in='paths',rows_out=lambda result: len(result[2]))
+def load_dumps(paths,type_id=2,min_apogee=500,max_perigee=650,chunksize=1000000,populations=None,n_threads=4):
+    """Function that loads the targets of a population from several dumps, e.g. overlapping windows of a longer study,
+       as one de-duplicated set of targets, states and propagations.
+    Args:
+        paths: paths of the dump_<timestamp>.h5 files, oldest first. When a row is in several dumps, the row of the 
+               last dump is kept for targets and of the first dump for states and propagations.
+        type_id, min_apogee, max_perigee, populations: population filter, see load_dump
+        chunksize: number of rows read at a time from table format keys
+        n_threads: number of dumps read at the same time. At most n_threads dumps are read ahead of the merge, which 
+                   bounds the memory used on top of the merged rows.
+    States are de-duplicated by id and propagations by (target_state_id, timestamp) with the keys of the rows already 
+    loaded (see LoadedRows), which are updated with every dump, so a dump is only compared with the propagations of its
+    states that are already loaded.
+    Returns:
+        targets_df, states_df, props_df as load_dump
+    """
+    paths = list(paths)
+    if not paths:
+        raise ValueError("load_dumps needs at least one dump path")
+    
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        targets = list(pool.map(lambda path: pd.read_hdf(path,key='targets'),paths))
+        targets_df = pd.concat(targets,ignore_index=True).drop_duplicates('id',keep='last')
+        targets_df = select_targets(targets_df,type_id,min_apogee,max_perigee,populations)
+        target_ids = targets_df['id'].to_numpy()
+        
+        loaded = LoadedRows()
+        states_parts = []
+        props_parts = []
+        pending = deque()
+        for path in paths:
+            pending.append(pool.submit(read_dump_rows,path,target_ids,chunksize))
+            if len(pending) >= n_threads:
+                loaded.merge(*pending.popleft().result(),states_parts,props_parts)
+        while pending:
+            loaded.merge(*pending.popleft().result(),states_parts,props_parts)
+    
+    states_df = pd.concat(states_parts,ignore_index=True)
+    props_df = pd.concat(props_parts,ignore_index=True)
+    states_df, props_df = sli.normalize_times(states_df,props_df)
+    return targets_df, states_df, props_df
+
+class LoadedRows():
+    """Class that holds the keys of the rows load_dumps has already loaded: the state ids, and the propagation timestamps
+       grouped by state. Both are updated with the new rows of every dump, so merging a dump costs the size of the dump,
+       not of all the rows loaded before it.
+    """
+    def __init__(self):
+        self.state_ids = set()
+        self.prop_timestamps = {}
+    
+    def merge(self,states_df,props_df,states_parts,props_parts):
+        """Method that appends the rows of a dump not loaded yet to states_parts and props_parts, and adds their keys."""
+        states_df = states_df.drop_duplicates('id')
+        ids = states_df['id'].tolist()
+        new_states = np.fromiter((state_id not in self.state_ids for state_id in ids),dtype=bool,count=len(ids))
+        states_parts.append(states_df[new_states])
+        self.state_ids.update(ids)
+        
+        props_df = props_df.drop_duplicates(PROP_KEY)
+        state_ids = props_df['target_state_id'].to_numpy()
+        timestamps = props_df['timestamp'].to_numpy()
+        new_props = np.ones(len(props_df),dtype=bool)
+        
+        dump_states = pd.unique(state_ids)
+        known = [self.prop_timestamps.get(state_id) for state_id in dump_states.tolist()]
+        is_known = np.fromiter((k is not None for k in known),dtype=bool,count=len(known))
+        if is_known.any():
+            known = [k for k in known if k is not None]
+            loaded = pd.MultiIndex.from_arrays([np.repeat(dump_states[is_known],[len(k) for k in known]),
+                                                np.concatenate(known)])
+            overlap = np.flatnonzero(pd.Index(dump_states[is_known]).get_indexer(state_ids) >= 0)
+            duplicate = pd.MultiIndex.from_arrays([state_ids[overlap],timestamps[overlap]]).isin(loaded)
+            new_props[overlap[duplicate]] = False
+        
+        kept = np.flatnonzero(new_props)
+        kept = kept[np.argsort(state_ids[kept],kind='stable')]
+        kept_states, starts = np.unique(state_ids[kept],return_index=True)
+        for state_id, kept_timestamps in zip(kept_states.tolist(),np.split(timestamps[kept],starts[1:])):
+            previous = self.prop_timestamps.get(state_id)
+            self.prop_timestamps[state_id] = (kept_timestamps if previous is None else 
+                                              np.concatenate((previous,kept_timestamps)))
+        props_parts.append(props_df[new_props])
@@ -0,0 +1,83 @@
+"""Parallel execution of the propagations from 'now' pipeline over a process pool.
+
+The state and propagation indexes are built once, written as .npy files and memory-mapped read-only by every worker, so 
+the large arrays are shared through the page cache instead of being pickled to each process. Work is split in 
+contiguous shards of 'now's (days and bins) and the shards are merged back in order, so the result does not depend on 
+the number of workers.
+"""
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import SLI_functions as sli
+
+def now_shard(index_dir,target_ids,nows,day_index,bin_index,horizons,cutoff):
+    """Function that runs one shard of 'now's in a worker.
+    Args:
+        index_dir: directory with the saved StateIndex and PropagationIndex
+        target_ids: array of the relevant target ids
+        nows: int64 unix nanoseconds of the 'now's of the shard
+        day_index, bin_index: day position and bin number of every 'now'
+        horizons: horizons (in days) of the propagations
+        cutoff: states older than cutoff days are not used
+    Returns:
+        rows: position in nows of every selected state
+        state_ids: selected state ids, in order of 'now' and target
+        table: PropTable of the shard
+    """
+    state_index = sli.StateIndex.load(index_dir)
+    prop_index = sli.PropagationIndex.load(index_dir)
+    
+    closest = state_index.closest_states(target_ids[np.newaxis,:],nows[:,np.newaxis],cutoff)
+    rows, cols = np.nonzero(~np.isnan(closest))
+    state_ids = closest[rows,cols].astype(np.int64)
+    
+    tables = []
+    for x in horizons:
+        eig_1, eig_2, eig_3, rms = prop_index.query(state_ids,nows[rows],x)
+        tables.append(sli.PropTable(day_index[rows],bin_index[rows],np.full(len(rows),x),target_ids[cols],state_ids,
+                                    eig_1,eig_2,eig_3,rms))
+    
+    return rows, state_ids, sli.PropTable.concat(tables)
+
+def now_props_all_days_parallel(day_list,target_id_list,states_df,props_df,horizons=(1,3),cutoff=7,
+                                n_workers=None,shards_per_worker=4,work_dir=None):
+    """Function that does sli.sort_target_states_in_days followed by sli.per_target_x_day_props_all_days for every 
+       horizon, with the days split over a pool of processes. The bins and props of the days are filled as by the serial
+       functions.
+    Args:
+        day_list: list of Day objects
+        target_id_list: list of the relevant target ids
+        states_df: states dataframe
+        props_df: propagations dataframe
+        horizons: horizons (in days) of the propagations
+        cutoff: states older than cutoff days are not used
+        n_workers: number of processes (default: number of CPUs)
+        shards_per_worker: number of shards per process, more shards balance uneven days better
+        work_dir: directory for the temporary memory-mapped index files (default: system temporary directory)
+    Returns:
+        PropTable of all days (see sli.store_props)
+    """
+    n_workers = n_workers or os.cpu_count() or 1
+    target_ids = np.asarray(target_id_list,dtype=np.int64)
+    
+    grid = sli.TimeGrid.of_days(day_list)
+    nows, day_index, bin_index = grid.bin_starts, grid.bin_day, grid.bin_number
+    shards = [shard for shard in np.array_split(np.arange(len(nows)),n_workers*shards_per_worker) if len(shard)]
+    
+    with tempfile.TemporaryDirectory(dir=work_dir) as index_dir:
+        sli.StateIndex(states_df,target_ids).save(index_dir)
+        sli.PropagationIndex(props_df,states_df).save(index_dir)
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            futures = [pool.submit(now_shard,index_dir,target_ids,nows[shard],day_index[shard],bin_index[shard],
+                                   horizons,cutoff) for shard in shards]
+            results = [future.result() for future in futures]
+    
+    for shard, (rows, state_ids, table) in zip(shards,results):
+        bounds = np.searchsorted(rows,np.arange(len(shard)+1))
+        for i, r in enumerate(shard):
+            day_list[day_index[r]].states_bins_8hr[bin_index[r]].extend(state_ids[bounds[i]:bounds[i+1]].tolist())
+    
+    return sli.store_props(day_list,sli.PropTable.concat([table for rows, state_ids, table in results]))
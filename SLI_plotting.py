@@ -0,0 +1,130 @@
+"""Batch rendering of the SLI figures from a percentile table.
+
+The table is the one written by SLI_cli (see SLI_cli.quantile_frame): one row per (day, bin, horizon, metric), with the
+'date' of the day and one 'p<quantile>' column per percentile, and optionally a 'population' column. Every population
+is drawn as one figure with a panel per metric (rows) and horizon (columns). The figure, its axes, ticks and lines are
+built once with the non-interactive Agg backend and only the data of the lines is replaced for the next population.
+Labels are rendered with mathtext unless usetex is asked for, which starts LaTeX for every label.
+
+    df = pd.read_csv('sli_now.csv')
+    render_report(df,'figures',mode='now')
+"""
+import os
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import numpy as np
+
+METRIC_LABELS = {'eig_1':r'$\sqrt{Max Eig}$ [m]','eig_2':r'$\sqrt{Mid Eig}$ [m]','eig_3':r'$\sqrt{Min Eig}$ [m]',
+                 'rms':r'RMS [m]'}
+STYLE = {'font.size':30,'axes.labelsize':30,'axes.labelweight':'heavy','xtick.labelsize':30,'ytick.labelsize':30,
+         'legend.fontsize':20,'figure.titlesize':30}
+
+def configure(usetex=False,style='ggplot'):
+    """Function that sets the style of the notebooks, with text.usetex only when usetex is True."""
+    plt.style.use(style)
+    plt.rcParams.update(STYLE)
+    plt.rcParams['text.usetex'] = usetex
+
+def quantile_columns(df):
+    """Helper function that returns the 'p<quantile>' columns of a percentile table."""
+    return [column for column in df.columns if column.startswith('p') and column[1:].replace('.','',1).isdigit()]
+
+def day_ticks(dates,n_bins,max_labels=31):
+    """Function that returns the x tick positions (start of a day, in bins) and labels (dates) of the figures, keeping
+       at most max_labels of them."""
+    step = max(1,int(np.ceil(len(dates)/max_labels)))
+    positions = np.arange(0,len(dates),step)*n_bins
+    return positions, [dates[d] for d in range(0,len(dates),step)]
+
+class ReportFigure():
+    """Class that holds a figure with one panel per (metric, horizon) and one line per percentile in each panel. The
+       axes, ticks and lines are created once; draw() only replaces the data of the lines.
+    """
+    def __init__(self,metrics,horizons,quantiles,dates,n_bins,figsize=None):
+        self.metrics = list(metrics)
+        self.horizons = list(horizons)
+        self.quantiles = list(quantiles)
+        self.n_bins = n_bins
+        if figsize is None:
+            figsize = (20*len(self.horizons),8*len(self.metrics))
+        self.fig, axes = plt.subplots(len(self.metrics),len(self.horizons),figsize=figsize,sharex=True,squeeze=False)
+        self.title = self.fig.suptitle('')
+        
+        positions, labels = day_ticks(list(dates),n_bins)
+        self.lines = {}
+        for i, metric in enumerate(self.metrics):
+            for j, horizon in enumerate(self.horizons):
+                ax = axes[i,j]
+                self.lines[(metric,horizon)] = [ax.plot([],[],label=column[1:])[0] for column in self.quantiles]
+                ax.set_yscale('log')
+                ax.set_ylabel(METRIC_LABELS.get(metric,metric))
+                if i == 0:
+                    ax.set_title('{:g} day propagations'.format(horizon))
+        for ax in axes[-1]:
+            ax.xaxis.set_ticks(positions)
+            ax.xaxis.set_ticklabels(labels)
+            for tick in ax.get_xticklabels():
+                tick.set_rotation(45)
+                tick.set_horizontalalignment('right')
+        axes[0,-1].legend(loc='upper left',bbox_to_anchor=(1.01,1.0),fancybox=True,shadow=True)
+        self.axes = axes
+        self.fig.tight_layout(rect=(0,0,1,0.97))
+    
+    def draw(self,df,title=''):
+        """Method that puts the percentiles of a table (of one population) in the lines of the panels."""
+        self.title.set_text(title)
+        for (horizon, metric), block in df.groupby(['horizon','metric'],sort=False):
+            lines = self.lines.get((metric,horizon))
+            if lines is None:
+                continue
+            xs = block['day'].to_numpy()*self.n_bins + block['bin'].to_numpy()
+            for line, column in zip(lines,self.quantiles):
+                values = block[column].to_numpy(dtype=np.float64)
+                line.set_data(xs,values if metric == 'rms' else np.sqrt(values))
+        for ax in self.axes.ravel():
+            ax.relim()
+            ax.autoscale_view()
+    
+    def save(self,path,dpi=100):
+        self.fig.savefig(path,dpi=dpi)
+    
+    def close(self):
+        plt.close(self.fig)
+
+def render_report(df,directory,mode='now',fmt='png',usetex=False,dpi=100,band=None):
+    """Function that saves the figures of a percentile table, one per population.
+    Args:
+        df: percentile table (see SLI_cli.quantile_frame), with an optional 'population' column
+        directory: directory of the figures, created if needed
+        mode: 'now' or 'epoch', used in the titles and file names
+        fmt: file format of the figures (png, pdf, svg, ...)
+        usetex: render the labels with LaTeX instead of mathtext
+        dpi: resolution of raster formats
+        band: optional description of the population added to the titles, e.g. 'Debris at 500km - 650km band'
+    Returns:
+        list of the paths of the figures
+    """
+    configure(usetex)
+    os.makedirs(directory,exist_ok=True)
+    
+    dates = df.drop_duplicates('day').sort_values('day')['date'].tolist()
+    n_bins = int(df['bin'].max())+1 if len(df) else 1
+    figure = ReportFigure(df['metric'].unique(),np.sort(df['horizon'].unique()),quantile_columns(df),dates,n_bins)
+    
+    origin = "'now'" if mode == 'now' else 'state epoch'
+    groups = df.groupby('population',sort=False) if 'population' in df.columns else [(None,df)]
+    paths = []
+    for population, block in groups:
+        title = "Quantiles of propagation covariances from {}.".format(origin)
+        for extra in (band,population):
+            if extra is not None:
+                title += " {}.".format(extra)
+        figure.draw(block,title)
+        name = mode if population is None else '{}_{}'.format(mode,population)
+        paths.append(os.path.join(directory,'{}.{}'.format(name,fmt)))
+        figure.save(paths[-1],dpi)
+    figure.close()
+    
+    return paths
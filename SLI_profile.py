@@ -0,0 +1,205 @@
+"""Instrumentation of the stages of the SLI pipelines.
+
+The stage functions of SLI_functions are decorated with stage(). While a Profiler is enabled, every call of a stage
+is recorded with its wall time, CPU time, peak memory (Python and numpy allocations traced with tracemalloc), input and
+output row counts and the counters its body reports with count(), e.g. the missing propagations or the targets dropped
+by the cutoff. When no profiler is enabled a stage costs one global lookup and count() does nothing.
+
+    with SLI_profile.profiling() as profiler:
+        sli.sort_target_states_in_days(day_list,target_ids,states_df)
+        sli.per_target_one_day_props_all_days(day_list,states_df,props_df)
+    profiler.to_json('profile.json')
+"""
+import contextlib
+import functools
+import inspect
+import json
+import time
+import tracemalloc
+
+_active = None
+
+class StageRecord():
+    """Class that holds the measures of one call of a stage. Nested stages are recorded separately, the measures of the
+       outer stage include them."""
+    __slots__ = ('name','depth','wall_s','cpu_s','peak_bytes','rows_in','rows_out','counters','_start','_memory')
+    
+    def __init__(self,name,depth):
+        self.name = name
+        self.depth = depth
+        self.wall_s = None
+        self.cpu_s = None
+        self.peak_bytes = None
+        self.rows_in = None
+        self.rows_out = None
+        self.counters = {}
+    
+    def to_dict(self):
+        return {'stage':self.name,'depth':self.depth,'wall_s':self.wall_s,'cpu_s':self.cpu_s,
+                'peak_bytes':self.peak_bytes,'rows_in':self.rows_in,'rows_out':self.rows_out,
+                'counters':dict(self.counters)}
+
+class Profiler():
+    """Class that collects the StageRecord of every stage called while it is enabled, in order of call.
+       With trace_memory=False peak memory is not measured, which avoids the slowdown of tracemalloc.
+    """
+    def __init__(self,trace_memory=True):
+        self.trace_memory = trace_memory
+        self.records = []
+        self.counters = {}
+        self._stack = []
+        self._started_tracing = False
+    
+    def start(self,record):
+        record._start = (time.perf_counter(),time.process_time())
+        if self.trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            # the peak so far belongs to the running stages, the new stage measures from here
+            for outer in self._stack:
+                outer.peak_bytes = max(outer.peak_bytes,peak - outer._memory)
+            tracemalloc.reset_peak()
+            record._memory = current
+            record.peak_bytes = 0
+        self.records.append(record)
+        self._stack.append(record)
+    
+    def stop(self,record):
+        wall, cpu = record._start
+        record.wall_s = time.perf_counter() - wall
+        record.cpu_s = time.process_time() - cpu
+        self._stack.pop()
+        if self.trace_memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            record.peak_bytes = max(record.peak_bytes,peak - record._memory)
+            for outer in self._stack:
+                outer.peak_bytes = max(outer.peak_bytes,peak - outer._memory)
+    
+    def count(self,name,n=1):
+        """Method that adds n to a counter of the running stage and to the totals of the profiler."""
+        n = int(n)
+        self.counters[name] = self.counters.get(name,0) + n
+        if self._stack:
+            counters = self._stack[-1].counters
+            counters[name] = counters.get(name,0) + n
+    
+    def output_rows(self,n):
+        """Method that sets the output row count of the running stage, in place of the one taken from its result."""
+        if self._stack:
+            self._stack[-1].rows_out = int(n)
+    
+    def report(self):
+        """Method that returns the report as a dictionary with the list of 'stages' (in order of call), the 'totals'
+           per stage name and the 'counters' of the whole run."""
+        totals = {}
+        for record in self.records:
+            total = totals.setdefault(record.name,{'calls':0,'wall_s':0.0,'cpu_s':0.0,'peak_bytes':None,
+                                                   'rows_in':None,'rows_out':None})
+            total['calls'] += 1
+            total['wall_s'] += record.wall_s or 0.0
+            total['cpu_s'] += record.cpu_s or 0.0
+            if record.peak_bytes is not None:
+                total['peak_bytes'] = max(total['peak_bytes'] or 0,record.peak_bytes)
+            for column in ('rows_in','rows_out'):
+                if getattr(record,column) is not None:
+                    total[column] = (total[column] or 0) + getattr(record,column)
+        return {'stages':[record.to_dict() for record in self.records],'totals':totals,'counters':dict(self.counters)}
+    
+    def to_json(self,path=None):
+        """Method that returns the report as a JSON string, also written to path when given."""
+        text = json.dumps(self.report(),indent=2)
+        if path is not None:
+            with open(path,'w') as f:
+                f.write(text)
+        return text
+    
+    def to_frame(self):
+        """Method that returns the stages as a dataframe, one row per call, with one column per counter."""
+        import pandas as pd
+        rows = []
+        for record in self.records:
+            row = record.to_dict()
+            row.update(row.pop('counters'))
+            rows.append(row)
+        return pd.DataFrame(rows)
+
+def enable(profiler=None):
+    """Function that makes profiler (a new Profiler by default) record the stages called from now on. Returns it."""
+    global _active
+    profiler = profiler if profiler is not None else Profiler()
+    if profiler.trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        profiler._started_tracing = True
+    _active = profiler
+    return profiler
+
+def disable():
+    """Function that stops recording the stages. Returns the profiler that was enabled, if any."""
+    global _active
+    profiler = _active
+    _active = None
+    if profiler is not None and profiler._started_tracing:
+        tracemalloc.stop()
+        profiler._started_tracing = False
+    return profiler
+
+@contextlib.contextmanager
+def profiling(trace_memory=True):
+    """Context manager that records the stages called inside it in a new Profiler, which it yields."""
+    profiler = enable(Profiler(trace_memory))
+    try:
+        yield profiler
+    finally:
+        disable()
+
+def active():
+    """Function that returns the enabled profiler, None when profiling is disabled."""
+    return _active
+
+def count(name,n=1):
+    """Function that adds n to a counter of the running stage. Does nothing when profiling is disabled."""
+    if _active is not None:
+        _active.count(name,n)
+
+def output_rows(n):
+    """Function that sets the output row count of the running stage, for stages whose result holds more rows than they
+       produced (e.g. the merged props of the days). Does nothing when profiling is disabled."""
+    if _active is not None:
+        _active.output_rows(n)
+
+def stage(name,rows_in=None,rows_out=len):
+    """Decorator that records the calls of a stage function while a profiler is enabled.
+    Args:
+        name: name of the stage in the report
+        rows_in: name of the argument whose len() is the input row count, or function of the bound arguments
+                 (dictionary) returning it
+        rows_out: function of the returned value giving the output row count (default: len), None when the stage 
+                  reports it with output_rows() or not at all
+    """
+    def decorator(function):
+        signature = inspect.signature(function)
+        
+        @functools.wraps(function)
+        def wrapper(*args,**kwargs):
+            profiler = _active
+            if profiler is None:
+                return function(*args,**kwargs)
+            
+            record = StageRecord(name,len(profiler._stack))
+            if rows_in is not None:
+                arguments = signature.bind(*args,**kwargs)
+                arguments.apply_defaults()
+                if callable(rows_in):
+                    record.rows_in = int(rows_in(arguments.arguments))
+                else:
+                    record.rows_in = len(arguments.arguments[rows_in])
+            profiler.start(record)
+            try:
+                result = function(*args,**kwargs)
+            finally:
+                profiler.stop(record)
+            if rows_out is not None:
+                record.rows_out = int(rows_out(result))
+            return result
+        
+        return wrapper
+    return decorator
@@ -0,0 +1,187 @@
+"""Local query service answering "what were the SLI quantiles at time T, for population P and horizon H".
+
+The state and propagation indexes are built (or memory-mapped, see SLI_store) once. A query for one bin is one as-of
+search of the closest state of every target of the population and one propagation lookup, both bisections over the
+sorted indexes, and the quantiles of the bins computed last are kept in an LRU cache, so repeated and overlapping
+queries do not recompute them. The service is a Python object (SLIService) and can also be served over HTTP with the
+standard library (serve).
+
+    service = SLIService.from_dump('dump_20221115T193154.h5')
+    service.point('2022-11-01 10:00','debris',1)
+    service.range('2022-11-01','2022-11-03','debris',3)
+
+    python SLI_service.py dump_20221115T193154.h5 --port 8050
+    curl 'http://127.0.0.1:8050/point?time=2022-11-01T10:00&horizon=1'
+"""
+import argparse
+import functools
+import json
+import sys
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+import SLI_functions as sli
+import SLI_loader as ld
+
+DEFAULT_POPULATIONS = [sli.Population('debris')]
+
+def time_ns(time):
+    """Helper function that returns the int64 unix nanoseconds of a datetime, a string or int64 unix nanoseconds."""
+    return int(time) if isinstance(time,(int,np.integer)) else int(sli.to_unix_ns(time)[0])
+
+class SLIService():
+    """Class that answers point-in-time and range queries of the SLI quantiles of the 'now' pipeline.
+    Args:
+        targets_df: targets dataframe (all targets of the populations)
+        states_df: states dataframe
+        props_df: propagations dataframe or summary (see sli.summarize_props), None when prop_index is given
+        populations: list of sli.Population objects that can be queried (default: debris at 500km - 650km)
+        prop_index: optional prebuilt or memory-mapped sli.PropagationIndex
+        cutoff: states older than cutoff days are not used
+        bin_hours: width of the bins, a divisor of 24. A query time is moved to the start of its bin.
+        quantiles: percentiles (0-100) reported
+        cache_size: number of (population, bin, horizon) results kept in the LRU cache
+        max_range_bins: largest number of bins of a range query, larger ranges are rejected
+    """
+    def __init__(self,targets_df,states_df,props_df=None,populations=None,prop_index=None,cutoff=7,bin_hours=8,
+                 quantiles=(10,25,50,75,95),cache_size=4096,max_range_bins=1000):
+        if 24 % bin_hours:
+            raise ValueError("bin_hours must divide 24, got {}".format(bin_hours))
+        populations = populations if populations is not None else DEFAULT_POPULATIONS
+        self.population_targets = {pop.name:np.sort(pop.select(targets_df)['id'].to_numpy()) for pop in populations}
+        target_ids = np.unique(np.concatenate(list(self.population_targets.values())+[np.zeros(0,dtype=np.int64)]))
+        
+        self.state_index = sli.StateIndex(states_df,target_ids)
+        self.prop_index = prop_index if prop_index is not None else sli.PropagationIndex(props_df,states_df)
+        self.cutoff = cutoff
+        self.bin_ns = int(sli.hours_to_ns(bin_hours))
+        self.quantiles = tuple(float(q) for q in quantiles)
+        self.max_range_bins = max_range_bins
+        self.bin_quantiles = functools.lru_cache(maxsize=cache_size)(self.compute_bin)
+    
+    @classmethod
+    def from_dump(cls,path,populations=None,use_summary=False,prop_store=None,**kwargs):
+        """Method that creates the service from a dump, loading only the targets of the populations, their states and
+           their propagations (or none of them when a propagation store directory is given, see SLI_store)."""
+        populations = populations if populations is not None else DEFAULT_POPULATIONS
+        targets_df, states_df, props_df = ld.load_dump(path,populations=populations,use_summary=use_summary,
+                                                       load_props=prop_store is None)
+        prop_index = None
+        if prop_store is not None:
+            import SLI_store
+            prop_index = SLI_store.open_prop_store(prop_store)
+        return cls(targets_df,states_df,props_df,populations,prop_index,**kwargs)
+    
+    def bin_start(self,time):
+        """Method that returns the start of the bin (int64 unix nanoseconds) of a time, given as a datetime, a string or
+           int64 unix nanoseconds."""
+        ns = time_ns(time)
+        return ns - ns % self.bin_ns
+    
+    def compute_bin(self,population,now,horizon):
+        """Method that computes the quantiles of one bin, called through the LRU cache by bin_quantiles.
+        Returns:
+            number of targets with a state within the cutoff, and a tuple with the quantiles of every metric
+        """
+        target_ids = self.population_targets[population]
+        closest = self.state_index.closest_states(target_ids,now,self.cutoff)
+        state_ids = closest[~np.isnan(closest)].astype(np.int64)
+        
+        metrics = self.prop_index.query(state_ids,now,horizon)
+        groups = np.zeros(len(state_ids),dtype=np.int64)
+        return len(state_ids), tuple(tuple(sli.grouped_quantiles(groups,np.asarray(values,dtype=np.float64),1,
+                                                                 self.quantiles)[0])
+                                     for values in metrics)
+    
+    def point(self,time,population='debris',horizon=1):
+        """Method that returns the quantiles of the bin of time, for a population and a horizon (in days).
+        Returns:
+            dictionary with 'population', 'bin_start' (ISO UTC), 'horizon', 'n_states' and 'quantiles', a dictionary
+            metric -> {quantile: value}, None for missing values
+        """
+        if population not in self.population_targets:
+            raise KeyError("Unknown population {}, known: {}".format(population,list(self.population_targets)))
+        now = self.bin_start(time)
+        n_states, values = self.bin_quantiles(population,now,float(horizon))
+        return {'population':population,
+                'bin_start':str(np.datetime64(now,'ns').astype('datetime64[s]')),
+                'horizon':float(horizon),'n_states':n_states,
+                'quantiles':{metric:{'{:g}'.format(q):(None if np.isnan(v) else float(v))
+                                     for q, v in zip(self.quantiles,metric_values)}
+                             for metric, metric_values in zip(sli.METRICS,values)}}
+    
+    def range(self,start,end,population='debris',horizon=1):
+        """Method that returns the point results of every bin from the bin of start up to (not including) end. Raises 
+           ValueError when the range has more than max_range_bins bins."""
+        nows = range(self.bin_start(start),time_ns(end),self.bin_ns)
+        if len(nows) > self.max_range_bins:
+            raise ValueError("Range of {} bins, at most {} are allowed".format(len(nows),self.max_range_bins))
+        return [self.point(now,population,horizon) for now in nows]
+    
+    def cache_info(self):
+        return self.bin_quantiles.cache_info()
+
+def make_handler(service):
+    """Function that returns the request handler class of the HTTP server of a service.
+       GET /point?time=T&population=P&horizon=H and GET /range?start=T0&end=T1&population=P&horizon=H return JSON.
+       Unknown populations, bad parameters and ranges of more than max_range_bins bins get a 400 response.
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            params = {name:values[-1] for name, values in parse_qs(url.query).items()}
+            population = params.get('population',next(iter(service.population_targets)))
+            try:
+                horizon = float(params.get('horizon',1))
+                if url.path == '/point':
+                    body = service.point(params['time'],population,horizon)
+                elif url.path == '/range':
+                    body = service.range(params['start'],params['end'],population,horizon)
+                else:
+                    self.send_error(404,"Unknown path {}".format(url.path))
+                    return
+            except (KeyError,ValueError) as error:
+                self.send_error(400,str(error))
+                return
+            data = json.dumps(body).encode()
+            self.send_response(200)
+            self.send_header('Content-Type','application/json')
+            self.send_header('Content-Length',str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        
+        def log_message(self,format,*args):
+            pass
+    
+    return Handler
+
+def serve(service,host='127.0.0.1',port=8050):
+    """Function that serves a service over HTTP until interrupted."""
+    server = ThreadingHTTPServer((host,port),make_handler(service))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+def main(argv=None):
+    """Function that loads a dump and serves it over HTTP."""
+    parser = argparse.ArgumentParser(description="Serve the SLI quantiles of a dump over HTTP.")
+    parser.add_argument('dump',help="path of the dump_<timestamp>.h5 file")
+    parser.add_argument('--host',default='127.0.0.1')
+    parser.add_argument('--port',type=int,default=8050)
+    parser.add_argument('--use-summary',action='store_true',help="read the propagation summary sidecar of the dump")
+    parser.add_argument('--prop-store',default=None,help="directory of a propagation store (see SLI_store) to use")
+    parser.add_argument('--cutoff',type=float,default=7)
+    parser.add_argument('--bin-hours',type=float,default=8)
+    parser.add_argument('--max-range-bins',type=int,default=1000,help="largest number of bins of a range query")
+    args = parser.parse_args(argv)
+    
+    service = SLIService.from_dump(args.dump,use_summary=args.use_summary,prop_store=args.prop_store,
+                                   cutoff=args.cutoff,bin_hours=args.bin_hours,max_range_bins=args.max_range_bins)
+    serve(service,args.host,args.port)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
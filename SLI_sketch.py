@@ -0,0 +1,122 @@
+"""Mergeable quantile sketches of the propagation elements, for SLI rollups over months, altitude bands or shards
+without keeping the raw values.
+
+Each group (e.g. (day, bin, horizon, metric)) is summarized by a log-bucketed histogram as in DDSketch: a value x is 
+counted in the bucket k = ceil(log|x| / log(gamma)), gamma = (1+alpha)/(1-alpha), and represented by 
+2*gamma**k/(gamma+1), which is within a relative error alpha of every value of the bucket. Sketches merge by adding 
+the counts of equal buckets, so merging is exact.
+
+Error bound: quantiles are interpolated between order statistics like np.percentile, using the bucket representatives.
+For groups whose values all have the same sign (eigenvalues and rms of valid covariances) the result is within a 
+relative error alpha of np.percentile of the raw values: |sketch - exact| <= alpha*|exact|. With alpha=0.01 the 
+sketch of a group needs at most about log(max/min)/0.02 buckets, e.g. ~1000 buckets for 9 orders of magnitude.
+"""
+import numpy as np
+import pandas as pd
+
+import SLI_functions as sli
+
+COUNT_COLUMNS = ['sign','bucket','count']
+
+class QuantileSketch():
+    """Class that holds one quantile sketch per group.
+    Args:
+        counts: dataframe with one column per group label followed by 'sign' (-1, 0 or 1), 'bucket' and 'count'
+        alpha: relative accuracy of the sketch
+    """
+    def __init__(self,counts,alpha=0.01):
+        self.counts = counts
+        self.alpha = alpha
+        self.gamma = (1+alpha)/(1-alpha)
+    
+    @property
+    def label_names(self):
+        return [name for name in self.counts.columns if name not in COUNT_COLUMNS]
+    
+    @classmethod
+    def from_values(cls,labels,values,alpha=0.01):
+        """Method that builds the sketches of values grouped by the columns of the labels dataframe. NaN values are 
+           ignored."""
+        values = np.asarray(values,dtype=np.float64)
+        valid = ~np.isnan(values)
+        gamma = (1+alpha)/(1-alpha)
+        magnitude = np.abs(values[valid])
+        sign = np.sign(values[valid]).astype(np.int8)
+        bucket = np.zeros(len(magnitude),dtype=np.int32)
+        nonzero = sign != 0
+        bucket[nonzero] = np.ceil(np.log(magnitude[nonzero])/np.log(gamma))
+        
+        rows = labels.loc[valid].reset_index(drop=True).assign(sign=sign,bucket=bucket)
+        counts = rows.groupby(list(rows.columns),sort=False).size().reset_index(name='count')
+        return cls(counts,alpha)
+    
+    @classmethod
+    def from_prop_table(cls,table,day_list=None,alpha=0.01,metrics=sli.METRICS):
+        """Method that builds one sketch per (day, bin, horizon, metric) of a PropTable. When day_list is given the 'day' 
+           label is the date key of the day (see sli.date_key_of_day) instead of its position, so sketches of different 
+           runs can be merged."""
+        day = table.day
+        if day_list is not None:
+            day = np.asarray([sli.date_key_of_day(d) for d in day_list],dtype=np.int64)[table.day]
+        n = len(table)
+        labels = pd.DataFrame({'day':np.tile(day,len(metrics)),'bin':np.tile(table.bin,len(metrics)),
+                               'horizon':np.tile(table.horizon,len(metrics)),'metric':np.repeat(list(metrics),n)})
+        values = np.concatenate([getattr(table,metric) for metric in metrics])
+        return cls.from_values(labels,values,alpha)
+    
+    def merge(self,*others):
+        """Method that returns the merged sketch of this and other sketches with the same labels and alpha."""
+        for other in others:
+            if other.alpha != self.alpha or other.label_names != self.label_names:
+                raise ValueError("Only sketches with the same alpha and labels can be merged.")
+        return self.rollup(self.label_names,[self]+list(others))
+    
+    def rollup(self,label_names,sketches=None):
+        """Method that merges the groups that only differ in labels other than label_names, e.g. rollup(['horizon', 
+           'metric']) gives one sketch per horizon and metric over all days and bins."""
+        sketches = [self] if sketches is None else sketches
+        counts = pd.concat([sketch.counts for sketch in sketches],ignore_index=True)
+        counts = counts.groupby(list(label_names)+['sign','bucket'],sort=False)['count'].sum().reset_index()
+        return QuantileSketch(counts,self.alpha)
+    
+    def quantiles(self,quantiles=(10,25,50,75,95)):
+        """Method that returns a dataframe indexed by the group labels with one column per quantile (0-100)."""
+        label_names = self.label_names
+        counts = self.counts.copy()
+        counts['value'] = counts['sign']*2*self.gamma**counts['bucket'].astype(np.float64)/(self.gamma+1)
+        counts = counts.sort_values(label_names+['value'],kind='stable')
+        
+        group = counts.groupby(label_names,sort=False).ngroup().to_numpy()
+        weight = counts['count'].to_numpy()
+        values = counts['value'].to_numpy()
+        cum = np.cumsum(weight)
+        n = np.bincount(group,weights=weight).astype(np.int64)
+        offsets = np.cumsum(n) - n
+        
+        result = np.empty((len(n),len(quantiles)))
+        for j, q in enumerate(quantiles):
+            pos = q/100*(n-1)
+            lo = np.floor(pos).astype(np.int64)
+            hi = np.minimum(lo+1,n-1)
+            v_lo = values[np.searchsorted(cum,offsets+lo,'right')]
+            v_hi = values[np.searchsorted(cum,offsets+hi,'right')]
+            result[:,j] = v_lo + (pos-lo)*(v_hi-v_lo)
+        
+        first = np.searchsorted(group,np.arange(len(n)))
+        index = pd.MultiIndex.from_frame(counts[label_names].iloc[first])
+        return pd.DataFrame(result,index=index,
+                            columns=pd.Index(np.asarray(quantiles,dtype=np.float64),name='quantile')).sort_index()
+    
+    def save(self,path):
+        """Method that writes the sketch to a compressed .npz file."""
+        columns = {name:self.counts[name].to_numpy() for name in self.counts.columns}
+        for name, values in columns.items():
+            if values.dtype == object:
+                columns[name] = values.astype(str)
+        np.savez_compressed(path,alpha=self.alpha,columns=np.asarray(list(self.counts.columns)),**columns)
+    
+    @classmethod
+    def load(cls,path):
+        with np.load(path) as data:
+            counts = pd.DataFrame({name:data[name] for name in data['columns']})
+            return cls(counts,float(data['alpha']))
@@ -0,0 +1,120 @@
+"""On-disk columnar store of the propagations of a dump, for dumps whose propagations do not fit in memory.
+
+The store is written once from the HDF5 dump, chunk by chunk. The eigenvalues and rms of every chunk are computed as it
+is read (so the covariance columns are never held whole) and its rows are appended to raw column files of partitions
+covering ranges of state ids. Each partition is then sorted by (state id, timestamp) on its own and copied to its place
+in .npy columns laid out as a saved sli.PropagationIndex. Partitions cover increasing state id ranges, so the columns
+are sorted as a whole: open_prop_store memory-maps them and the lookups of both pipelines read only the pages they probe.
+
+    store = open_prop_store(directory)
+    sli.props_for_all_days(day_list,None,states_df,horizons,prop_index=store)
+    sli.per_target_x_day_props_all_days(day_list,states_df,None,x,prop_index=store)
+"""
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+import SLI_functions as sli
+import SLI_loader as ld
+
+DTYPES = {'state_ids':np.int64,'timestamps':np.int64,
+          'eig_1':np.float64,'eig_2':np.float64,'eig_3':np.float64,'rms':np.float64}
+
+def partition_bounds(state_ids,states_per_partition=200000):
+    """Function that splits the state ids in ranges of at most states_per_partition states.
+    Returns:
+        int64 array with the first state id of every partition. The first bound is the smallest int64, so that every
+        propagation falls in a partition, also when its state is not in state_ids.
+    """
+    state_ids = np.unique(np.asarray(state_ids,dtype=np.int64))
+    bounds = state_ids[::states_per_partition].copy()
+    if len(bounds) == 0:
+        bounds = np.zeros(1,dtype=np.int64)
+    bounds[0] = np.iinfo(np.int64).min
+    return bounds
+
+def part_path(directory,part,name):
+    """Helper function that returns the path of the raw column file of a partition."""
+    return os.path.join(directory,'part_{:05d}_{}.bin'.format(part,name))
+
+def write_prop_store(path,directory,states_per_partition=200000,chunksize=1000000):
+    """Function that writes the propagations of a dump to a propagation store.
+    Args:
+        path: path of the dump_<timestamp>.h5 file
+        directory: directory of the store, created if needed
+        states_per_partition: number of states per partition. A partition is sorted in memory, so its propagations
+                              have to fit (about 48 bytes per propagation).
+        chunksize: number of propagation rows read at a time from table format keys
+    Returns:
+        number of propagations in the store
+    """
+    os.makedirs(directory,exist_ok=True)
+    for name in os.listdir(directory):
+        if name.startswith('part_'):
+            os.remove(os.path.join(directory,name))
+    
+    with pd.HDFStore(path,mode='r') as store:
+        state_ids = np.concatenate([chunk['id'].to_numpy(dtype=np.int64)
+                                    for chunk in ld.iter_key_chunks(store,'states',['id'],chunksize)])
+        bounds = partition_bounds(state_ids,states_per_partition)
+        counts = np.zeros(len(bounds),dtype=np.int64)
+        
+        for chunk in ld.iter_key_chunks(store,'propagations',ld.PROP_COLUMNS,chunksize):
+            eigs, rms = sli.prop_eigs_and_rms(chunk)
+            columns = {'state_ids':chunk['target_state_id'].to_numpy(dtype=np.int64),
+                       'timestamps':sli.prop_epoch_ns(chunk),
+                       'eig_1':eigs[:,0],'eig_2':eigs[:,1],'eig_3':eigs[:,2],'rms':rms}
+            
+            part = np.searchsorted(bounds,columns['state_ids'],'right') - 1
+            order = np.argsort(part,kind='stable')
+            edges = np.searchsorted(part[order],np.arange(len(bounds)+1))
+            for k in np.flatnonzero(np.diff(edges)):
+                rows = order[edges[k]:edges[k+1]]
+                for name, dtype in DTYPES.items():
+                    with open(part_path(directory,k,name),'ab') as f:
+                        columns[name][rows].astype(dtype).tofile(f)
+                counts[k] += len(rows)
+    
+    offsets = np.concatenate([[0],np.cumsum(counts)])
+    out = {name:np.lib.format.open_memmap(os.path.join(directory,'{}_{}.npy'.format(sli.PropagationIndex.prefix,name)),
+                                          mode='w+',dtype=dtype,shape=(int(offsets[-1]),))
+           for name, dtype in DTYPES.items()}
+    for k in np.flatnonzero(counts):
+        part = {name:np.fromfile(part_path(directory,k,name),dtype=dtype) for name, dtype in DTYPES.items()}
+        order = np.lexsort((part['timestamps'],part['state_ids']))
+        for name in DTYPES:
+            out[name][offsets[k]:offsets[k+1]] = part[name][order]
+            os.remove(part_path(directory,k,name))
+    for column in out.values():
+        column.flush()
+    del out
+    
+    with open(os.path.join(directory,'meta.json'),'w') as f:
+        json.dump({'dump':os.path.basename(path),'bounds':bounds.tolist(),'offsets':offsets.tolist()},f)
+    
+    return int(offsets[-1])
+
+def open_prop_store(directory):
+    """Function that memory-maps a propagation store read-only as a sli.PropagationIndex, to be passed as prop_index to
+       the pipeline functions."""
+    return sli.PropagationIndex.load(directory)
+
+def iter_partitions(directory):
+    """Function that yields the partitions of a propagation store one by one, for streaming over the propagations.
+    Yields:
+        first state id of the partition (None for the first one) and a sli.PropagationIndex whose arrays are zero-copy
+        slices of the memory-mapped store
+    """
+    with open(os.path.join(directory,'meta.json')) as f:
+        meta = json.load(f)
+    store = open_prop_store(directory)
+    
+    for k, (lo, hi) in enumerate(zip(meta['offsets'][:-1],meta['offsets'][1:])):
+        if hi == lo:
+            continue
+        part = sli.PropagationIndex.__new__(sli.PropagationIndex)
+        for name in sli.PropagationIndex.arrays:
+            setattr(part,name,getattr(store,name)[lo:hi])
+        yield (meta['bounds'][k] if k else None), part
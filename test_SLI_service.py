@@ -0,0 +1,100 @@
+"""Offline tests of the query service, on a synthetic dump and a local HTTP server on a free port."""
+import json
+import threading
+import urllib.error
+import urllib.request
+
+import numpy as np
+import pytest
+
+import SLI_benchmark as bm
+import SLI_functions as sli
+import SLI_service as sv
+
+HORIZONS = (1,3)
+
+@pytest.fixture(scope='module')
+def dump():
+    targets_df, states_df, props_df = bm.make_dump(n_targets=30,states_per_target=10,days=6,seed=1)
+    states_df, props_df = sli.normalize_times(states_df,props_df)
+    return targets_df, states_df, props_df
+
+@pytest.fixture(scope='module')
+def service(dump):
+    return sv.SLIService(*dump,max_range_bins=10)
+
+@pytest.fixture(scope='module')
+def reference(dump):
+    """Quantiles of the 'now' pipeline, indexed by (day, bin, horizon, metric), and its day list."""
+    targets_df, states_df, props_df = dump
+    day_list = sli.create_day_list(states_df)
+    sli.sort_target_states_in_days(day_list,sli.filter_targets(targets_df)['id'].to_numpy(),states_df)
+    for x in HORIZONS:
+        table = sli.per_target_x_day_props_all_days(day_list,states_df,props_df,x)
+    return sli.prop_quantiles(table,day_list=day_list), day_list
+
+@pytest.fixture(scope='module')
+def server(service):
+    httpd = sv.ThreadingHTTPServer(('127.0.0.1',0),sv.make_handler(service))
+    thread = threading.Thread(target=httpd.serve_forever,daemon=True)
+    thread.start()
+    yield 'http://127.0.0.1:{}'.format(httpd.server_address[1])
+    httpd.shutdown()
+    httpd.server_close()
+
+def quantile_values(result,metric):
+    return np.array([np.nan if v is None else v for v in result['quantiles'][metric].values()],dtype=np.float64)
+
+def get_json(url):
+    with urllib.request.urlopen(url) as response:
+        return json.loads(response.read())
+
+def test_point_matches_pipeline(service,reference):
+    quantiles, day_list = reference
+    for d, day in enumerate(day_list):
+        for i, now in enumerate(day.now):
+            for x in HORIZONS:
+                result = service.point(now,'debris',x)
+                assert result['bin_start'] == now.isoformat()
+                for metric in sli.METRICS:
+                    np.testing.assert_allclose(quantile_values(result,metric),
+                                               quantiles.loc[(d,i,float(x),metric)].to_numpy())
+
+def test_point_moves_time_to_bin_start_and_caches(service,reference):
+    day = reference[1][2]
+    first = service.point(day.now[1],'debris',1)
+    hits = service.cache_info().hits
+    assert service.point(day.now[1] + (day.now[2]-day.now[1])/2,'debris',1) == first
+    assert service.cache_info().hits == hits + 1
+
+def test_point_unknown_population(service,reference):
+    with pytest.raises(KeyError):
+        service.point(reference[1][0].now[0],'payload',1)
+
+def test_range_returns_every_bin(service,reference):
+    day_list = reference[1]
+    results = service.range(day_list[1].now[1],day_list[2].now[2],'debris',3)
+    assert [r['bin_start'] for r in results] == [now.isoformat() for now in day_list[1].now[1:]+day_list[2].now[:2]]
+    assert results[0] == service.point(day_list[1].now[1],'debris',3)
+
+def test_range_rejects_too_many_bins(service,reference):
+    day_list = reference[1]
+    with pytest.raises(ValueError):
+        service.range(day_list[0].now[0],day_list[4].now[0],'debris',1)
+
+def test_http_point_and_range(server,service,reference):
+    day_list = reference[1]
+    now = day_list[3].now[2].isoformat()
+    assert get_json('{}/point?time={}&horizon=3'.format(server,now)) == service.point(now,'debris',3)
+    results = get_json('{}/range?start={}&end={}&population=debris'.format(server,day_list[3].date_string_of_day(),
+                                                                           day_list[4].date_string_of_day()))
+    assert len(results) == 3
+
+@pytest.mark.parametrize('query, status',[('/range?start=2000-01-01&end=2030-01-01',400),
+                                          ('/point?time=2022-10-03&population=payload',400),
+                                          ('/point?horizon=1',400),
+                                          ('/points?time=2022-10-03',404)])
+def test_http_errors(server,query,status):
+    with pytest.raises(urllib.error.HTTPError) as error:
+        urllib.request.urlopen(server+query)
+    assert error.value.code == status